@@ -13,6 +13,23 @@ import os.path
 import logging
 
 
+# column types of the owner store files. Columns not listed here are not transferred to the store.
+store_dtypes = {"owner_name": "category",
+                "repo_id": "int64",
+                "actor_id": "Int64",
+                "actor_login": "category",
+                "comment_body": "string",
+                "comment_id": "int64"}
+
+store_thread_dtypes = {"IssueCommentEvent": {"issue_id": "int64"},
+                       "PullRequestReviewCommentEvent": {"pull_request_id": "int64",
+                                                         "comment_position": "float64"},
+                       "CommitCommentEvent": {"commit_id": "str",
+                                              "comment_position": "float64"}}
+
+store_extension = ".parquet"
+
+
 def main():
     start = time.time()
 
@@ -201,6 +218,36 @@ def prep_comments(file):
         print("Chunk processed ({0:.2f}s)".format(time.time() - lapstart))
     print()
 
+    write_store(file, export_dir)
+
+
+def write_store(file, export_dir):
+    """
+    Converts the owner csv files of a comment event type to typed parquet files, which are read by the network
+    construction process instead of the csv files.
+
+    :param file:            comment event type
+    :param export_dir:      folder containing the owner csv files
+    :return:                --
+    """
+
+    logging.info("writing store files for " + file)
+
+    dtypes = dict(store_dtypes, **store_thread_dtypes[file])
+
+    start = time.time()
+    for f in os.listdir(export_dir):
+        if f.endswith(store_extension):
+            continue
+
+        path = os.path.join(export_dir, f)
+        data = pd.read_csv(path, usecols=lambda col: col in dtypes, dtype=dtypes)
+        data["comment_body"] = data["comment_body"].fillna("")
+
+        data.to_parquet(path + store_extension, index=False)
+
+    print("Store written for {0} ({1:.2f}s)".format(file, time.time() - start))
+
 
 def normalize_other(chunk, chunksize, counter):
 
@@ -349,12 +349,17 @@ MERGE (c)-[:to]->(r);
 
 
 // -- import references:
+// the relations file carries a header (owner, repo_id, addressee_id, comment_id, ref_type, thread_type, rule_set).
+// output written with nc_relations_format = "arrow" (.arrows) cannot be loaded directly; convert it to csv first:
+// read_relations(path, "arrow").to_csv("<name>_relations.csv", index=False) (classes/relations.py)
 USING PERIODIC COMMIT 1000
-LOAD CSV FROM 'file:///Relations/180307_relations.csv' AS row
+LOAD CSV WITH HEADERS FROM 'file:///Relations/180307_relations.csv' AS row
+// each rule set in conf.nc_rule_sets writes its own rows; load one of them only to avoid duplicate edges
+WITH row WHERE row.rule_set = 'relaxed'
 WITH
-	toInt(row[0]) as user_id,
-	toInt(row[1]) as comment_id,
-	row[2] as ref_type
+	toInt(row.addressee_id) as user_id,
+	toInt(row.comment_id) as comment_id,
+	row.ref_type as ref_type
 MATCH (user:USER{gha_id:user_id})
 MATCH (comment:COMMENT{gha_id:comment_id})
 WITH comment, user, ref_type
@@ -1,14 +1,118 @@
+"""
+MODULE: collectors
+
+Collects information about data quality issues during network construction: invalid references and comments
+without a position. Memory use is bounded: totals are counted exactly, examples are kept as a fixed size reservoir
+sample, and all invalid references can optionally be spilled to one file per owner.
+
+Collectors are kept per process. Workers of a parallel run pass their state to the main process with pop_state, where
+it is merged with merge_state.
+"""
+from collections import Counter
+import os
+
+import numpy as np
 import pandas as pd
 
 import conf as conf
 
-_invalid_references = []
-_position_nan = []
+_invalid_counts = Counter()
+_invalid_seen = 0
+_invalid_samples = []
+
+_position_nan = {"comments": 0, "nan": 0, "files": 0}
+
+_random_state = np.random.RandomState(0)
+
+
+def add_invalid_references(owner, repo, references):
+    """
+    :param owner:           owner name
+    :param repo:            repository id
+    :param references:      data frame of invalid references with the columns commenter_id, addressee_id (NA, if
+                            the addressee is unknown), comment_id, ref_type, thread_type, rule_set and reason
+    :return:                --
+    """
+    global _invalid_seen
+
+    if not conf.collect_invalid or references.empty:
+        return
+
+    references = references.assign(owner=owner, repo_id=repo)
+
+    _invalid_counts.update(zip(references["reason"], references["ref_type"], references["thread_type"]))
+
+    for position in _reservoir_positions(len(references)):
+        record = references.iloc[position[0]].to_dict()
+        if position[1] < len(_invalid_samples):
+            _invalid_samples[position[1]] = record
+        else:
+            _invalid_samples.append(record)
+
+    _invalid_seen += len(references)
+
+    if conf.collect_spill:
+        _spill(conf.get_invalid_spill_path(owner), references)
+
+
+def _reservoir_positions(no_records):
+    """
+    reservoir sampling (algorithm R) over a batch of records, vectorized over the batch.
+
+    :param no_records:      number of records in the batch
+    :return:                list of (position in the batch, slot in the reservoir) in the order they have to be applied
+    """
+    size = conf.collect_sample_size
+
+    no_filled = min(max(size - len(_invalid_samples), 0), no_records)
+    positions = [(i, len(_invalid_samples) + i) for i in range(no_filled)]
+
+    seen = _invalid_seen + np.arange(no_filled, no_records) + 1
+    slots = (_random_state.random_sample(len(seen)) * seen).astype(np.int64)
+    for i in np.flatnonzero(slots < size):
+        positions.append((no_filled + int(i), int(slots[i])))
+
+    return positions
+
+
+def _spill(path, references):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
 
+    references.to_csv(path, mode='a', header=not os.path.isfile(path), index=False)
 
-def add_invalid_reference(ref):
-    if conf.collect_invalid:
-        _invalid_references.append(ref.get_info_as_dict())
+
+def discard_spilled(completed):
+    """
+    removes spilled invalid references of repositories which have not been processed completely, e.g. by a run that
+    was interrupted. They are spilled again when the repository is processed after resuming.
+
+    :param completed:   set of (owner, repo_id) tuples which have been processed completely
+    :return:            --
+    """
+    if not os.path.isdir(conf._collectors_folder):
+        return
+
+    for name in sorted(os.listdir(conf._collectors_folder)):
+        path = os.path.join(conf._collectors_folder, name)
+        if not (name.startswith("invalid_") and name.endswith(".csv")):
+            continue
+
+        temp_path = path + ".tmp"
+        header = True
+        discarded = 0
+        for chunk in pd.read_csv(path, dtype={"owner": str}, chunksize=100000):
+            keep = np.array([(owner, int(repo)) in completed
+                             for owner, repo in zip(chunk["owner"], chunk["repo_id"])], dtype=bool)
+            discarded += int((~keep).sum())
+            chunk[keep].to_csv(temp_path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+
+        if discarded:
+            os.replace(temp_path, path)
+        elif os.path.isfile(temp_path):
+            os.remove(temp_path)
 
 
 def analyze_invalid_refs():
@@ -16,41 +120,109 @@ def analyze_invalid_refs():
     if not conf.collect_invalid:
         return
 
-    df = pd.DataFrame(_invalid_references)
-    a_is_c = df[df["addressee"] == df["commenter"]]
-    foo_owner_addressee = df[df["addressee"] == "fooOwner"]
-    foo_owner_commenter = df[df["commenter"] == "fooOwner"]
-
-    addressee_vals = df.groupby(by="addressee", axis=1,)
+    counts = pd.Series(_invalid_counts, dtype="int64")
 
     print("-------------------------------")
     print("### invalid reference statistics ###")
     print()
-    print("total count invalid ref:              {0}".format(len(df)))
-    print("count ref with a == c:                {0}".format(len(a_is_c)))
-    print("count ref with a == 'fooOwner':       {0}".format(len(foo_owner_addressee)))
-    print("count ref with c == 'fooOwner':       {0}".format(len(foo_owner_commenter)))
+    print("total count invalid ref:              {0}".format(_invalid_seen))
+
+    if _invalid_seen:
+        print()
+        print("count by reason:")
+        print(counts.groupby(level=0).sum().to_string())
+        print()
+        print("count by reference type:")
+        print(counts.groupby(level=1).sum().to_string())
+        print()
+        print("count by thread type:")
+        print(counts.groupby(level=2).sum().to_string())
+        print()
+        print("sample of {0} invalid references:".format(len(_invalid_samples)))
+        print(pd.DataFrame(_invalid_samples).head(20).to_string(index=False))
+
+    if conf.collect_spill:
+        print()
+        print("all invalid references written to {0}".format(conf._collectors_folder))
     print()
 
-    print("unique addressee values")
-    print(addressee_vals)
-
 
-def add_position_nan(nan_list):
+def add_position_nan(no_nan, no_comments):
+    """
+    :param no_nan:          number of comments without position in one of an owner's comment files
+    :param no_comments:     number of comments in the file
+    :return:                --
+    """
     if conf.collect_position_nan:
-        _position_nan.append(nan_list)
+        _position_nan["comments"] += no_comments
+        _position_nan["nan"] += no_nan
+        _position_nan["files"] += no_nan > 0
 
 
 def analyze_position_nan():
     if not conf.collect_position_nan:
         return
 
-    # TODO: implement printing some stats here
-    # _position_nan.describe()
+    share = 100.0 * _position_nan["nan"] / _position_nan["comments"] if _position_nan["comments"] else 0
 
     print("-------------------------------")
     print("### nan statistics (position-field) ###")
 
     print()
-    print("number of nan found:                 {0}".format(len(_position_nan)))
+    print("number of nan found:                 {0}".format(_position_nan["nan"]))
+    print("share of comments:                   {0:.2f}%".format(share))
+    print("comment files affected:              {0}".format(_position_nan["files"]))
     print()
+
+
+def pop_state():
+    """
+    :return:    state of all collectors of this process. The collectors are reset afterwards.
+    """
+    global _invalid_counts, _invalid_seen, _invalid_samples, _position_nan
+
+    state = {"invalid_counts": _invalid_counts,
+             "invalid_seen": _invalid_seen,
+             "invalid_samples": _invalid_samples,
+             "position_nan": _position_nan}
+
+    _invalid_counts = Counter()
+    _invalid_seen = 0
+    _invalid_samples = []
+    _position_nan = {"comments": 0, "nan": 0, "files": 0}
+
+    return state
+
+
+def merge_state(state):
+    """
+    merges a state returned by pop_state into the collectors of this process. The merged reservoir sample takes each
+    example from either sample with a probability proportional to the number of references the sample was drawn from.
+
+    :param state:   collector state
+    :return:        --
+    """
+    global _invalid_seen, _invalid_samples
+
+    _invalid_counts.update(state["invalid_counts"])
+
+    own = list(_invalid_samples)
+    other = list(state["invalid_samples"])
+    _random_state.shuffle(own)
+    _random_state.shuffle(other)
+
+    own_weight = _invalid_seen
+    other_weight = state["invalid_seen"]
+
+    merged = []
+    while len(merged) < conf.collect_sample_size and (own or other):
+        if other and (not own or _random_state.random_sample() * (own_weight + other_weight) >= own_weight):
+            merged.append(other.pop())
+        else:
+            merged.append(own.pop())
+
+    _invalid_samples = merged
+    _invalid_seen += state["invalid_seen"]
+
+    for key, value in state["position_nan"].items():
+        _position_nan[key] += value
@@ -0,0 +1,66 @@
+"""
+MODULE: contextuals
+
+Streaming detection of contextual replies. A contextual reply is a comment which does not reference anybody
+explicitly but answers to the previous comment in the thread.
+
+CLASSES:
+    ContextualDetector
+"""
+
+
+class ContextualDetector:
+    """detects contextual replies in a single pass over the comments of a thread.
+
+    Comments are fed in thread order. The detector keeps the set of participants seen so far and the previous
+    commenter. A comment is a contextual reply to the previous commenter, ...
+    ... if the thread had at most two participants before the comment and the commenter changed
+    ... if the thread had more than two participants before the comment, unless the comment opens with a
+        reference or references the previous commenter explicitly."""
+
+    __slots__ = ["_participants", "_previous"]
+
+    def __init__(self):
+        self._participants = set()
+        self._previous = None
+
+    def get_state(self):
+        """
+        :return:        tuple of the participants seen so far and the previous commenter
+        """
+        return list(self._participants), self._previous
+
+    def set_state(self, participants, previous):
+        """
+        Restores a state returned by get_state, so that the detector continues a thread where it left off.
+
+        :param participants:    participants seen so far
+        :param previous:        previous commenter or None
+        :return:                --
+        """
+        self._participants = set(participants)
+        self._previous = previous
+
+    def feed(self, commenter, addressees=(), leading=False):
+        """
+        Processes the next comment of the thread.
+
+        :param commenter:       actor key of the commenter
+        :param addressees:      addressees of the valid mentions and quotes in the comment
+        :param leading:         true, if the comment opens with a valid mention or quote
+        :return:                addressee of the contextual reply or None, if the comment isn't one
+        """
+        previous = self._previous
+        addressee = None
+
+        if previous is not None:
+            if len(self._participants) > 2:
+                if not leading and previous not in addressees:
+                    addressee = previous
+            elif commenter != previous:
+                addressee = previous
+
+        self._participants.add(commenter)
+        self._previous = commenter
+
+        return addressee
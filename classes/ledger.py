@@ -0,0 +1,150 @@
+"""
+MODULE: ledger
+
+Keeps track of the progress of the network construction process, so that an interrupted run can be resumed.
+
+CLASSES:
+    ProgressLedger
+"""
+import csv
+import io
+import os
+import zlib
+
+import pandas as pd
+
+
+class ProgressLedger:
+    """Append-only record of the owner/repository combinations which have been processed completely.
+
+    Each row holds the number of relations written for the repository, a CRC32 checksum over the bytes of these
+    relations and the offset of the end of these relations in the relations file (target). Rows are
+    appended with a single write call and flushed to disk immediately, so that the ledger never refers to
+    relations which are not on disk."""
+
+    _columns = ["owner", "repo_id", "rows", "checksum", "target", "offset"]
+
+    def __init__(self, path):
+        self._path = path
+
+    def create(self):
+        """
+        Creates the ledger file with its header, unless it exists already. The file is created exclusively, so that
+        concurrent writers never write the header twice.
+
+        :return:    --
+        """
+        try:
+            fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return
+
+        try:
+            os.write(fd, (",".join(self._columns) + "\n").encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def record(self, owner, repo_id, rows, target, start_offset, end_offset):
+        """
+        Records a completed repository.
+
+        :param owner:           owner name
+        :param repo_id:         repository id
+        :param rows:            number of relations written for the repository
+        :param target:          file the relations were appended to
+        :param start_offset:    offset of the repository's first relation in the target file
+        :param end_offset:      offset after the repository's last relation in the target file
+        :return:                --
+        """
+        checksum = self._checksum(target, start_offset, end_offset)
+
+        line = io.StringIO()
+        csv.writer(line, lineterminator="\n").writerow([owner,
+                                                        repo_id,
+                                                        rows,
+                                                        "{0:08x}".format(checksum),
+                                                        target,
+                                                        end_offset])
+
+        self.create()
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line.getvalue().encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self) -> pd.DataFrame:
+        """
+        :return:    all records as data frame
+        """
+        if not os.path.isfile(self._path):
+            return pd.DataFrame(columns=self._columns)
+
+        return pd.read_csv(self._path, dtype={"owner": str, "checksum": str, "target": str})
+
+    def get_completed(self) -> set:
+        """
+        :return:    set of (owner, repo_id) tuples which have been processed completely
+        """
+        records = self.read()
+        return set(zip(records["owner"], records["repo_id"].astype(int)))
+
+    def get_targets(self) -> set:
+        """
+        :return:    set of files relations have been written to
+        """
+        return set(self.read()["target"])
+
+    def truncate(self, target):
+        """
+        Removes relations from the target file which have been written after the last completed repository, e.g.
+        by a repository that was being processed when the run was interrupted.
+
+        :param target:      relations file
+        :return:            --
+        """
+        records = self.read()
+        records = records[records["target"] == target]
+
+        offset = int(records["offset"].max()) if not records.empty else 0
+
+        if not os.path.isfile(target):
+            if offset > 0:
+                raise FileNotFoundError("relations file {0} is missing, but contains completed "
+                                        "repositories according to the ledger".format(target))
+            return
+
+        size = self._file_size(target)
+        if size < offset:
+            raise ValueError("relations file {0} is shorter ({1} bytes) than the relations of the completed "
+                             "repositories according to the ledger ({2} bytes)".format(target, size, offset))
+
+        if size > offset:
+            with open(target, 'r+b') as f:
+                f.truncate(offset)
+
+    @staticmethod
+    def _file_size(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return 0
+
+    @staticmethod
+    def _checksum(path, start, stop):
+        checksum = 0
+        if stop <= start:
+            return checksum
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                checksum = zlib.crc32(chunk, checksum)
+                remaining -= len(chunk)
+
+        return checksum
@@ -164,6 +164,44 @@ class Neo4jController:
 
         return links
 
+    def get_communication_links(self,
+                                owner: str) -> pd.DataFrame:
+        """
+        Queries all communication links between users of an owner's repositories together with the time of the
+        comment which established them. The result serves as input to windowed analyses, which cut out their time
+        frames in memory instead of querying each time frame separately.
+
+        :param owner:   repository owner
+        :return:        pd.DataFrame with the columns source, target and event_time (ms since epoch), sorted by
+                        event_time
+        """
+
+        q_links = '''
+            MATCH (o:OWNER{login:$l_owner})
+
+            MATCH (comment:COMMENT) -[:to]-> () -[:to]-> (r) -[:belongs_to]-> (o)
+            WITH comment
+
+            MATCH (source:USER) -[:makes]-> (comment) -[x]-> (target:USER)
+            WHERE id(source) <> id(target)
+
+            RETURN
+            id(source) as source,
+            id(target) as target,
+            comment.event_time as event_time
+        '''
+
+        links = pd.DataFrame(self.graph.data(q_links, parameters={"l_owner": owner}),
+                             columns=["source", "target", "event_time"])
+
+        if conf.a_filter_core and not links.empty:
+            dev_core = self.get_dev_core(owner)
+
+            links = links[(links['source'].isin(dev_core['u_id']) &
+                           links['target'].isin(dev_core['u_id']))]
+
+        return links.sort_values(by="event_time", kind="mergesort").reset_index(drop=True)
+
     def get_viz_data(self,
                      owner: str):
         """
@@ -0,0 +1,128 @@
+"""
+MODULE: participants
+
+Interns actor ids to dense integer keys, which are used to identify actors during reference detection.
+
+CLASSES:
+    ActorRegistry
+    ParticipantIndex
+"""
+import numpy as np
+import pandas as pd
+
+
+class ActorRegistry:
+    """Owner-wide mapping between actor ids, lowercased actor logins and dense integer keys 0..n-1.
+
+    The registry is built once per owner when the comment data is imported. Lowercasing and dictionary construction
+    therefore happen once per owner instead of once per project and thread."""
+
+    def __init__(self, comment_data):
+        """
+        :param comment_data:    list of data frames with actor_id and actor_login columns. If an actor login occurs
+                                with several actor ids, the last occurrence wins
+        """
+        actor_ids = pd.concat([data["actor_id"] for data in comment_data], ignore_index=True)
+        actor_logins = pd.concat([data["actor_login"].astype(str) for data in comment_data], ignore_index=True)
+
+        keys, unique_ids = pd.factorize(actor_ids)
+        self._actor_ids = pd.Index(unique_ids)
+
+        logins = pd.DataFrame({"login": actor_logins, "key": keys}).drop_duplicates(keep="last")
+        self._logins = dict(zip(logins["login"].str.lower(), logins["key"].tolist()))
+
+    def __len__(self):
+        return len(self._actor_ids)
+
+    def add_keys(self, data):
+        """
+        :param data:    data frame with an actor_id column
+        :return:        copy of data with an additional actor_key column
+        """
+        return data.assign(actor_key=self._actor_ids.get_indexer(data["actor_id"]))
+
+    def get_key(self, actor_login):
+        """
+        :param actor_login:     lowercase actor login
+        :return:                key of the actor or None, if the login is unknown
+        """
+        return self._logins.get(actor_login)
+
+    def get_actor_id(self, key):
+        """
+        :param key:             key of an actor
+        :return:                actor id
+        """
+        return self._actor_ids[key]
+
+    def get_actor_ids(self, keys):
+        """
+        :param keys:            array of actor keys
+        :return:                np.array of actor ids
+        """
+        return self._actor_ids.values[np.asarray(keys, dtype=np.int64)]
+
+    def get_keys(self, actor_ids):
+        """
+        :param actor_ids:       list of actor ids
+        :return:                list of actor keys, -1 for unknown actor ids
+        """
+        return self._actor_ids.get_indexer(actor_ids).tolist()
+
+
+class ParticipantIndex:
+    """View of an ActorRegistry restricted to the participants of a project."""
+
+    def __init__(self, registry, keys):
+        """
+        :param registry:    owner's ActorRegistry
+        :param keys:        iterable of the participants' keys, may contain duplicates
+        """
+        self._registry = registry
+        self._keys = frozenset(keys)
+        self._mask = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def contains(self, keys):
+        """
+        :param keys:            np.array of actor keys of the owner's ActorRegistry
+        :return:                boolean np.array, true for keys of project participants
+        """
+        if self._mask is None:
+            self._mask = np.zeros(len(self._registry), dtype=bool)
+            self._mask[list(self._keys)] = True
+
+        return self._mask[keys]
+
+    def get_key(self, actor_login):
+        """
+        :param actor_login:     lowercase actor login
+        :return:                key of the actor or None, if the login is unknown to the owner
+        """
+        return self._registry.get_key(actor_login)
+
+    def get_actor_id(self, key):
+        """
+        :param key:             key of an actor
+        :return:                actor id
+        """
+        return self._registry.get_actor_id(key)
+
+    def get_actor_ids(self, keys):
+        """
+        :param keys:            array of actor keys
+        :return:                np.array of actor ids
+        """
+        return self._registry.get_actor_ids(keys)
+
+    def get_keys(self, actor_ids):
+        """
+        :param actor_ids:       list of actor ids
+        :return:                list of actor keys, -1 for actor ids unknown to the owner
+        """
+        return self._registry.get_keys(actor_ids)
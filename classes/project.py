@@ -1,5 +1,11 @@
+import classes.collectors as collectors
 import conf
+import numpy as np
 import pandas as pd
+from .participants import ActorRegistry, ParticipantIndex
+from .references import ReferenceBuffer
+from .relations import RelationsWriter
+from .rules import get_rule_sets, get_settings
 from .threads import Thread
 
 
@@ -9,69 +15,124 @@ class Project:
 
     _export_folder = "Export_Network/"
 
-    def __init__(self, pullreq_data, issue_data, commit_data, owner, repo):
+    def __init__(self, pullreq_data, issue_data, commit_data, owner, repo, registry=None, writer=None, cache=None,
+                 thread_states=None):
+        """
+        :param pullreq_data:    pull request comments of the project
+        :param issue_data:      issue comments of the project
+        :param commit_data:     commit comments of the project
+        :param owner:           owner name
+        :param repo:            repository id
+        :param registry:        owner's ActorRegistry. The comment data is expected to carry its actor_key column.
+                                If not provided, a registry is built from the project's data
+        :param writer:          RelationsWriter the relations are passed to. If not provided, the relations are
+                                appended to the relations file set in conf
+        :param cache:           owner's ThreadCache. If provided, threads which did not change since they were cached
+                                are not processed again
+        :param thread_states:   owner's ThreadStateStore. If provided, the project is processed incrementally: only
+                                comments after each thread's high-water mark are searched for references
+        """
 
         self.owner = owner
         self.repo = repo
 
+        self._writer = writer
+        self._thread_cache = cache
+        self._thread_states = thread_states
+
+        if registry is None:
+            registry = ActorRegistry([pullreq_data, commit_data, issue_data])
+            pullreq_data = registry.add_keys(pullreq_data)
+            issue_data = registry.add_keys(issue_data)
+            commit_data = registry.add_keys(commit_data)
+
         self._pullreq_data = pullreq_data
         self._issue_data = issue_data
         self._commit_data = commit_data
 
         self._threads = None
 
-        self._references = None
+        self._rule_sets = get_rule_sets(conf.nc_rule_sets)
+        self._reference_buffer = ReferenceBuffer([rule_set.name for rule_set in self._rule_sets])
+        self._no_references = 0
 
-        self._participants = pd.DataFrame(pd.concat([self._pullreq_data["actor_id"],
-                                                     self._issue_data["actor_id"],
-                                                     self._commit_data["actor_id"]])
-                                          .unique(),
-                                          columns=["participants"])
+        self._participants = ParticipantIndex(registry,
+                                              pd.concat([self._pullreq_data["actor_key"],
+                                                         self._issue_data["actor_key"],
+                                                         self._commit_data["actor_key"]]).unique().tolist())
 
-        pullreq_actors = self._actor_login_id(pullreq_data)
-        commit_actors = self._actor_login_id(commit_data)
-        issue_actors = self._actor_login_id(issue_data)
+        self.stats = ProjectStats(self)
 
-        self._actor_dict = (pd.concat([pullreq_actors,
-                                      commit_actors,
-                                       issue_actors],
-                                      axis="index"))\
-            .set_index('actor_login')\
-            .to_dict()\
-            .get('actor_id')
+    def get_actor_key(self, actor_login):
+        return self._participants.get_key(actor_login)
 
-        self.stats = ProjectStats(self)
+    def get_actor_id(self, key):
+        return self._participants.get_actor_id(key)
 
-    @staticmethod
-    def _actor_login_id(comment_df):
-        return pd.concat([comment_df["actor_id"], comment_df["actor_login"].str.lower()], axis="columns")
+    def get_participants(self):
+        return self._participants
+
+    def get_reference_buffer(self):
+        return self._reference_buffer
+
+    def get_rule_sets(self):
+        return self._rule_sets
+
+    def get_thread_cache(self):
+        return self._thread_cache
+
+    def get_thread_states(self):
+        return self._thread_states
 
-    def get_actor_id(self, actor_login):
-        return self._actor_dict.get(actor_login)
+    def get_detection_settings(self):
+        return get_settings([rule_set.name for rule_set in self._rule_sets])
+
+    def get_no_references(self):
+        return self._no_references
 
     def run(self):
-        self._threads = self._split_threads("pullreq") + \
-                        self._split_threads("issue") + \
-                        self._split_threads("commit")
+        if self._writer is None:
+            with RelationsWriter(conf.get_relations_file_path(), conf.nc_relations_format) as writer:
+                self._run(writer)
+        else:
+            self._run(self._writer)
+
+        self.stats.print_summary()
 
+    def _run(self, writer):
+        """
+        runs all threads of the project and passes their references to the writer. In streaming mode, threads are
+        dropped after they have been run and their references are passed on in chunks of about nc_stream_rows.
+
+        :param writer:      RelationsWriter
+        :return:            --
+        """
         self.stats.add_participants(len(self._participants))
 
-        self._references = self._collect_references()
+        threads = []
+        for thread_type in ["pullreq", "issue", "commit"]:
+            for thread in self._split_threads(thread_type):
+                if not conf.nc_streaming:
+                    threads.append(thread)
+                elif len(self._reference_buffer) >= conf.nc_stream_rows:
+                    self._emit_references(writer)
 
-        self._references.to_csv(conf.get_relations_file_path(),
-                                header=False,
-                                mode='a',
-                                index=False)
+        self._emit_references(writer)
 
-        self.stats.print_summary()
+        if not conf.nc_streaming:
+            self._threads = threads
 
     # -------- is ------
-    def is_participant(self, name):
-        return name in self._participants
+    def is_participant(self, key):
+        return key in self._participants
 
     # -------- threads -------
     def _split_threads(self, thread_type, start=None, stop=None):
-        """splits the project data into single threads and passes them to new thread objects"""
+        """splits the project data into single threads and passes them to new thread objects. The threads are run
+        and yielded one after another.
+
+        The data is sorted once by thread id, position and comment id. Each thread then is a contiguous slice of the
+        sorted data. start and stop select a range of threads by their position in the sorted thread ids."""
 
         if thread_type == "issue":
             data = self._issue_data
@@ -82,48 +143,92 @@ class Project:
         else:
             raise ValueError
 
-        thread_ids = data["thread_id"].unique()
+        if thread_type in ["pullreq", "commit"]:
+            keys = ["thread_id", "comment_position"]
+        else:
+            keys = ["thread_id"]
+
+        data = data.sort_values(by=keys + ["comment_id"], axis="rows", ascending=True)
+
+        thread_bounds = self._partition_bounds(data, ["thread_id"])
+        slice_bounds = self._partition_bounds(data, keys)
 
         if start is None:
             start = 0
         if stop is None:
-            stop = len(thread_ids)
-
-        thread_list = []
-        i = start
-        while i < stop:
-            next_thread = thread_ids.item(i)
-            thread_data = data[data["thread_id"] == next_thread]
-
-            if thread_type in ["pullreq", "commit"]:
+            stop = len(thread_bounds) - 1
 
-                positions = thread_data["comment_position"].unique()
-                for pos in positions:
-                    thread_position_data = thread_data[thread_data["comment_position"] == pos]
-                    new_thread = Thread(thread_position_data, thread_type, self.stats, self)
-                    new_thread.run()
-                    thread_list.append(new_thread)
+        first = np.searchsorted(slice_bounds, thread_bounds[start])
+        last = np.searchsorted(slice_bounds, thread_bounds[stop])
 
-            else:
-                new_thread = Thread(thread_data, thread_type, self.stats, self)
-                new_thread.run()
-                thread_list.append(new_thread)
+        for i in range(first, last):
+            new_thread = Thread(data.iloc[slice_bounds[i]:slice_bounds[i + 1]], thread_type, self.stats, self)
+            new_thread.run()
+            yield new_thread
 
-            i = i + 1
-
-        return thread_list
-
-    def _collect_references(self):
-        refs = []
-        for thread in self._threads:
-            ref_list = thread.get_references_as_list()
-            if refs:
-                refs.extend(ref_list)
-            else:
-                refs = ref_list
-
-        ref_df = pd.DataFrame(refs)
-        return ref_df
+    @staticmethod
+    def _partition_bounds(data, keys):
+        """
+        finds the rows at which a new partition begins in data sorted by keys.
+
+        :param data:    data frame sorted by keys
+        :param keys:    list of column names
+        :return:        np.array with the first row of each partition, followed by the number of rows
+        """
+        no_rows = len(data)
+        if no_rows == 0:
+            return np.array([0])
+
+        is_first = np.zeros(no_rows, dtype=bool)
+        is_first[0] = True
+        for key in keys:
+            values = data[key].values
+            is_first[1:] |= values[1:] != values[:-1]
+
+        return np.append(np.flatnonzero(is_first), no_rows)
+
+    def _emit_references(self, writer):
+        """validates the buffered candidate references at once, reports them to the project stats and passes the
+        valid ones to the writer. Clears the buffer.
+
+        :param writer:      RelationsWriter
+        :return:            --
+        """
+        buffer = self._reference_buffer
+        valid, outside_thread = buffer.validate(self._participants)
+
+        # stats refer to the first rule set
+        self.stats.add_reference_counts(buffer.count(), buffer.count(valid), buffer)
+        self.stats.add_outside_thread(int(np.count_nonzero(outside_thread & buffer.select_rule_set(0))))
+
+        if conf.collect_invalid:
+            collectors.add_invalid_references(self.owner, self.repo, self._describe_invalid(buffer.to_frame(~valid)))
+
+        ref_df = buffer.to_frame(valid).drop(columns="commenter_key")
+        ref_df.insert(0, "addressee_id", self._participants.get_actor_ids(ref_df.pop("addressee_key")))
+
+        writer.write(self.owner, self.repo, ref_df)
+        self._no_references += len(ref_df)
+
+        buffer.clear()
+
+    def _describe_invalid(self, invalid):
+        """
+        :param invalid:     data frame of invalid references as returned by ReferenceBuffer.to_frame
+        :return:            data frame with actor ids instead of actor keys and the reason each reference is invalid
+        """
+        commenter_keys = invalid.pop("commenter_key").values
+        addressee_keys = invalid.pop("addressee_key").values
+        known = addressee_keys >= 0
+
+        addressee_ids = np.zeros(len(invalid), dtype=np.int64)
+        addressee_ids[known] = self._participants.get_actor_ids(addressee_keys[known])
+
+        invalid.insert(0, "addressee_id", pd.arrays.IntegerArray(addressee_ids, ~known))
+        invalid.insert(0, "commenter_id", self._participants.get_actor_ids(commenter_keys))
+        invalid["reason"] = np.where(~known, "unknown addressee",
+                                     np.where(addressee_keys == commenter_keys, "self reference", "not a participant"))
+        return invalid
 
 
 class ProjectStats:
@@ -134,10 +239,6 @@ class ProjectStats:
         self._no_comments = 0
         self._no_participants = 0
 
-        self._quotes = []
-        self._mentions = []
-        self._contextuals = []
-
         self._quotes_sourced = 0
         self._quotes_not_sourced = 0
 
@@ -147,6 +248,13 @@ class ProjectStats:
         self._contextuals_found_total = 0
         self._contextuals_found_valid = 0
 
+        # valid references to project participants who don't participate in the reference's thread
+        self._outside_thread = 0
+
+        # contextual replies written by an earlier incremental run, which a pending mention that became valid
+        # would have suppressed
+        self._superseded_contextuals = 0
+
         self._contextuals_total = {"issue": 0, "pullreq": 0, "commit": 0}
         self._mentions_total = {"issue": 0, "pullreq": 0, "commit": 0}
         self._quotes_total = {"issue": 0, "pullreq": 0, "commit": 0}
@@ -170,30 +278,44 @@ class ProjectStats:
     def add_participants(self, no_participants):
         self._no_participants += no_participants
 
-    def add_quote(self, comment_id, sourced, thread_type):
-        self._quotes.append([comment_id])
-        if sourced:
-            self._quotes_sourced += 1
-        else:
-            self._quotes_not_sourced += 1
+    def add_reference_counts(self, found, valid, buffer):
+        """
+        :param found:       np.array with the number of references found per reference and thread type
+        :param valid:       np.array with the number of valid references per reference and thread type
+        :param buffer:      ReferenceBuffer the counts were taken from, which defines the type codes
+        """
+        add = {"Mention": self.add_mentions, "Quote": self.add_quotes, "ContextualReply": self.add_contextuals}
+
+        for i, ref_type in enumerate(buffer.ref_types):
+            for j, thread_type in enumerate(buffer.thread_types):
+                add[ref_type](int(found[i, j]), int(valid[i, j]), thread_type)
+
+    def add_outside_thread(self, no_references):
+        self._outside_thread += no_references
+
+    def add_superseded_contextual(self):
+        self._superseded_contextuals += 1
+
+    def add_quotes(self, no_found, no_sourced, thread_type):
+        self._quotes_sourced += no_sourced
+        self._quotes_not_sourced += no_found - no_sourced
 
-        self._quotes_total[thread_type] += 1
+        self._quotes_total[thread_type] += no_found
+        self._quotes_valid[thread_type] += no_sourced
 
-    def add_mentions(self, comment_id, valid, thread_type):
-        self._mentions.append([comment_id])
-        self._mentions_found_total += 1
-        if valid:
-            self._mentions_found_valid += 1
+    def add_mentions(self, no_found, no_valid, thread_type):
+        self._mentions_found_total += no_found
+        self._mentions_found_valid += no_valid
 
-        self._mentions_total[thread_type] += 1
+        self._mentions_total[thread_type] += no_found
+        self._mentions_valid[thread_type] += no_valid
 
-    def add_contextual(self, comment_id, valid, thread_type):
-        self._contextuals.append([comment_id])
-        self._contextuals_found_total += 1
-        if valid:
-            self._contextuals_found_valid += 1
+    def add_contextuals(self, no_found, no_valid, thread_type):
+        self._contextuals_found_total += no_found
+        self._contextuals_found_valid += no_valid
 
-        self._contextuals_total[thread_type] += 1
+        self._contextuals_total[thread_type] += no_found
+        self._contextuals_valid[thread_type] += no_valid
 
     def export_summary(self):
         pass
@@ -225,6 +347,7 @@ class ProjectStats:
         print("### Project Stats Summary ###")
         print()
         print("project name:                    {0}/{1}".format(self._parent_project.owner, self._parent_project.repo))
+        print("rule set:                        {0}".format(self._parent_project.get_rule_sets()[0].name))
         print()
         print("no participants:          {0}".format(self._no_participants))
         print("no threads:               {0}".format(self._no_threads))
@@ -248,5 +371,8 @@ class ProjectStats:
         print("sum:                         \t\t{0}".format(self._quotes_sourced
                                                             + self._mentions_found_valid
                                                             + self._contextuals_found_valid))
+        print("outside thread:              \t\t{0}".format(self._outside_thread))
+        if conf.nc_incremental:
+            print("superseded contextuals:      \t\t{0}".format(self._superseded_contextuals))
 
 
@@ -1,93 +1,242 @@
+"""
+MODULE: references
+
+Candidate references found in comments and the project-level buffer collecting them.
+
+CLASSES:
+    Reference
+    Mention
+    Quote
+    ContextualReply
+    ReferenceBuffer
+"""
+from array import array
+
+import numpy as np
+import pandas as pd
+
+
+def _to_numpy(values, dtype):
+    """copies an array.array to a np.array, so that the buffer stays resizable"""
+    return np.frombuffer(values, dtype=dtype).copy()
+
+
 class Reference:
+    """Candidate reference from the author of a comment (commenter) to another actor (addressee).
+
+    Actors are identified by their keys in the owner's ActorRegistry. References only live while their comment is
+    processed. Afterwards, they are appended to the project's ReferenceBuffer, which validates them."""
+
+    __slots__ = ["commenter_key", "addressee_key", "comment_id", "thread_type", "start_pos"]
+
+    # position of the reference type in ReferenceBuffer.ref_types
+    type_code = None
 
     def __init__(self,
-                 commenter_id: int,
-                 addressee,
+                 commenter_key: int,
+                 addressee_key,
                  comment_id: int,
-                 parent_thread,
-                 project_stats,
-                 thread_type: str):
+                 thread_type: str,
+                 start_pos=None):
         """
-        :param commenter_id:            commenter id
-        :param addressee:                adressee login or id
+        :param commenter_key:           commenter key in the owner's ActorRegistry
+        :param addressee_key:           addressee key in the owner's ActorRegistry or None, if it is unknown
         :param comment_id:
-        :param parent_thread:
-        :param project_stats:           Project stats object
         :param thread_type:             'pullreq', 'issue' or 'commit'
+        :param start_pos:               position of the reference in the comment body
         """
-        self.commenter_id = commenter_id
+        self.commenter_key = commenter_key
+        self.addressee_key = addressee_key
         self.comment_id = int(comment_id)
         self.thread_type = thread_type
-        self._parent_thread = parent_thread
-        self._project_stats = project_stats
-        self.addressee_id = self._convert_login_to_id(addressee)
-
-        self._valid = self._validate()
-        self._add_to_report()
+        self.start_pos = start_pos
 
-        self._start_pos = None
+    def get_start_pos(self):
+        return self.start_pos
 
-    def is_valid(self):
-        return self._valid
+    def is_resolved(self):
+        """
+        :return:        true, if the addressee is known and differs from the commenter
+        """
+        return self.addressee_key is not None and self.addressee_key != self.commenter_key
 
-    def set_start_pos(self, start_pos):
-        self._start_pos = start_pos
 
-    def get_start_pos(self):
-        return self._start_pos
+class Mention(Reference):
+    __slots__ = ["addressee_login"]
+    type_code = 0
 
-    def get_info_as_dict(self):
+    def __init__(self, commenter_key, addressee_key, comment_id, thread_type, start_pos=None, addressee_login=None):
         """
-        :return:          info required for import to neo4j
+        :param addressee_login:         lowercase login the addressee key was looked up with
         """
-        return ({"addressee_id": self.addressee_id,
-                 "comment_id": self.comment_id,
-                 "ref_type": type(self).__name__,
-                 "thread_type": self.thread_type})
+        super().__init__(commenter_key, addressee_key, comment_id, thread_type, start_pos)
+        self.addressee_login = addressee_login
 
-    def _convert_login_to_id(self, actor):
-        if type(actor) is str:
-            actor = self._parent_thread.parent_project.get_actor_id(actor)
-        return actor
 
-    def _validate(self):
-        """
-        Check if the reference is valid.
-        It is valid, if...
-        ... addressee and commenter differ
-        ... addressee participates in (one of) the repository's threads.
+class Quote(Reference):
+    __slots__ = ()
+    type_code = 1
+
+
+class ContextualReply(Reference):
+    __slots__ = ()
+    type_code = 2
+
 
-        Invalid references will be removed.
+# reference classes by type code
+reference_classes = [Mention, Quote, ContextualReply]
 
-        :return:        true or false
+
+class ReferenceBuffer:
+    """columnar buffer of the candidate references of a project.
+
+    Threads append their candidates, so that validation and counting run as array operations over the whole
+    project. Reference types, thread types and rule sets are stored as codes, unknown addressees as -1. Every thread
+    registers its participants, which allows checking whether an addressee participates in the reference's
+    thread."""
+
+    ref_types = ["Mention", "Quote", "ContextualReply"]
+    thread_types = ["pullreq", "issue", "commit"]
+
+    def __init__(self, rule_sets=("relaxed",)):
+        """
+        :param rule_sets:       names of the rule sets the references are found with. Rule set codes are positions
+                                in this list
+        """
+        self.rule_sets = list(rule_sets)
+
+        self._commenter_keys = array("q")
+        self._addressee_keys = array("q")
+        self._comment_ids = array("q")
+        self._ref_types = array("b")
+        self._thread_types = array("b")
+        self._thread_nos = array("q")
+        self._rule_set_codes = array("b")
+
+        self._participant_keys = array("q")
+        self._participant_thread_nos = array("q")
+        self._no_threads = 0
+
+    def __len__(self):
+        return len(self._comment_ids)
+
+    def clear(self):
+        """removes all references and thread participants. Thread numbers keep counting up."""
+        for values in [self._commenter_keys, self._addressee_keys, self._comment_ids, self._ref_types,
+                       self._thread_types, self._thread_nos, self._rule_set_codes, self._participant_keys,
+                       self._participant_thread_nos]:
+            del values[:]
+
+    def add_thread(self, participant_keys):
         """
-        if self.addressee_id is None or self.commenter_id is None:
-            return False
+        :param participant_keys:    keys of the thread's participants
+        :return:                    number of the thread in the buffer
+        """
+        thread_no = self._no_threads
+        self._no_threads += 1
 
-        elif self.addressee_id != self.commenter_id and \
-                self._parent_thread.is_participant(self.addressee_id) or \
-                self._parent_thread.parent_project.is_participant(self.addressee_id):
-                return True
-        else:
-            return False
+        self._participant_keys.extend(participant_keys)
+        self._participant_thread_nos.extend([thread_no] * (len(self._participant_keys) -
+                                                           len(self._participant_thread_nos)))
+        return thread_no
 
-    def _add_to_report(self):
-        pass
+    def extend(self, thread_no, references, rule_set=0):
+        """
+        :param thread_no:       number of the references' thread, as returned by add_thread
+        :param references:      iterable of references
+        :param rule_set:        code of the rule set the references were found with
+        """
+        thread_types = self.thread_types
+        for reference in references:
+            self._commenter_keys.append(reference.commenter_key)
+            self._addressee_keys.append(-1 if reference.addressee_key is None else reference.addressee_key)
+            self._comment_ids.append(reference.comment_id)
+            self._ref_types.append(reference.type_code)
+            self._thread_types.append(thread_types.index(reference.thread_type))
+            self._thread_nos.append(thread_no)
+            self._rule_set_codes.append(rule_set)
+
+    def get_columns(self):
+        """
+        :return:        dict of np.arrays: commenter_key, addressee_key, comment_id, ref_type, thread_type, thread_no,
+                        rule_set
+        """
+        return {"commenter_key": _to_numpy(self._commenter_keys, np.int64),
+                "addressee_key": _to_numpy(self._addressee_keys, np.int64),
+                "comment_id": _to_numpy(self._comment_ids, np.int64),
+                "ref_type": _to_numpy(self._ref_types, np.int8),
+                "thread_type": _to_numpy(self._thread_types, np.int8),
+                "thread_no": _to_numpy(self._thread_nos, np.int64),
+                "rule_set": _to_numpy(self._rule_set_codes, np.int8)}
+
+    def select_rule_set(self, rule_set):
+        """
+        :param rule_set:    code of a rule set
+        :return:            boolean np.array, true for references found with the rule set
+        """
+        return _to_numpy(self._rule_set_codes, np.int8) == rule_set
 
+    def validate(self, participants):
+        """
+        A reference is valid, if...
+        ... the addressee is known
+        ... addressee and commenter differ
+        ... addressee participates in (one of) the repository's threads.
 
-class Mention(Reference):
+        :param participants:    ParticipantIndex of the project
+        :return:                tuple of boolean np.arrays: valid references and valid references to actors who
+                                don't participate in the reference's thread
+        """
+        columns = self.get_columns()
+        addressees = columns["addressee_key"]
 
-    def _add_to_report(self):
-        self._project_stats.add_mentions(self.comment_id, self._valid, self.thread_type)
+        valid = (addressees >= 0) & (addressees != columns["commenter_key"])
+        valid[valid] = participants.contains(addressees[valid])
 
+        in_thread = np.isin(self._pair_codes(columns["thread_no"], addressees),
+                            self._pair_codes(_to_numpy(self._participant_thread_nos, np.int64),
+                                             _to_numpy(self._participant_keys, np.int64)))
 
-class Quote(Reference):
+        return valid, valid & ~in_thread
 
-    def _add_to_report(self):
-        self._project_stats.add_quote(self.comment_id, self._valid, self.thread_type)
+    def count(self, mask=None, rule_set=0):
+        """
+        :param mask:        boolean np.array selecting the references to count. Defaults to all references
+        :param rule_set:    code of the rule set to count the references of
+        :return:            np.array of shape (len(ref_types), len(thread_types)) with the number of references
+        """
+        columns = self.get_columns()
+        codes = columns["ref_type"].astype(np.int64) * len(self.thread_types) + columns["thread_type"]
 
+        selected = self.select_rule_set(rule_set)
+        if mask is not None:
+            selected &= mask
+        codes = codes[selected]
 
-class ContextualReply(Reference):
+        counts = np.bincount(codes, minlength=len(self.ref_types) * len(self.thread_types))
+        return counts.reshape(len(self.ref_types), len(self.thread_types))
 
-    def _add_to_report(self):
-        self._project_stats.add_contextual(self.comment_id, self._valid, self.thread_type)
\ No newline at end of file
+    def to_frame(self, mask=None):
+        """
+        :param mask:        boolean np.array selecting the references. Defaults to all references
+        :return:            data frame with the columns commenter_key, addressee_key, comment_id, ref_type,
+                            thread_type and rule_set, ordered by thread, rule set and reference type
+        """
+        columns = self.get_columns()
+        if mask is not None:
+            columns = {name: values[mask] for name, values in columns.items()}
+
+        order = np.lexsort((columns["ref_type"], columns["rule_set"], columns["thread_no"]))
+
+        return pd.DataFrame({
+            "commenter_key": columns["commenter_key"][order],
+            "addressee_key": columns["addressee_key"][order],
+            "comment_id": columns["comment_id"][order],
+            "ref_type": np.array(self.ref_types, dtype=object)[columns["ref_type"][order]],
+            "thread_type": np.array(self.thread_types, dtype=object)[columns["thread_type"][order]],
+            "rule_set": np.array(self.rule_sets, dtype=object)[columns["rule_set"][order]]})
+
+    @staticmethod
+    def _pair_codes(thread_nos, keys):
+        """combines thread numbers and actor keys to single integers"""
+        return (thread_nos << 32) | (keys & 0xFFFFFFFF)
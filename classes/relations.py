@@ -0,0 +1,258 @@
+"""
+MODULE: relations
+
+Writes the relations found during network construction to disk and reads them back.
+
+Relations are written either as CSV with a header line or as a sequence of zstd compressed Arrow IPC streams.
+Every write of the arrow format is a complete stream (schema, record batch, end marker), so that files can be cut
+after any write and concatenated without decoding.
+
+CLASSES:
+    RelationsWriter
+
+FUNCTIONS:
+    merge_relations
+    read_relations
+"""
+import os
+import shutil
+
+import pandas as pd
+
+columns = ["owner", "repo_id", "addressee_id", "comment_id", "ref_type", "thread_type", "rule_set"]
+
+_formats = ["csv", "arrow"]
+
+
+class RelationsWriter:
+    """Relations file which stays open for the whole run.
+
+    Relations are buffered and written once at least batch_rows of them are pending. A repository is committed
+    after all of its relations have been passed to the writer. Committed repositories are recorded in the progress
+    ledger as soon as their relations are on disk. Relations of repositories which have not been committed yet are
+    written separately, so that the ledger never covers them.
+
+    The relations of a repository are written one after another, so they form a contiguous span of the file. The
+    writer keeps track of the span of each repository, which is recorded in the ledger with the repository."""
+
+    def __init__(self, path, relations_format="csv", batch_rows=100000, ledger=None):
+        """
+        :param path:                relations file. Relations are appended, if the file exists
+        :param relations_format:    "csv" or "arrow"
+        :param batch_rows:          minimum number of relations per write
+        :param ledger:              ProgressLedger committed repositories are recorded in
+        """
+        if relations_format not in _formats:
+            raise ValueError("unknown relations format '{0}', use one of {1}".format(relations_format, _formats))
+
+        self._path = path
+        self._format = relations_format
+        self._batch_rows = batch_rows
+        self._ledger = ledger
+
+        self._schema = _arrow_schema() if relations_format == "arrow" else None
+
+        self._file = open(path, 'ab')
+        if relations_format == "csv" and self._file.tell() == 0:
+            self._file.write((",".join(columns) + "\n").encode())
+
+        # pending (repository, frame) tuples in the order they were passed to the writer. Commits have no frame.
+        self._pending = []
+        self._pending_rows = 0
+        self._rows = {}
+
+        # start and end offset of the relations written per repository which has not been recorded yet
+        self._spans = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, owner, repo_id, references):
+        """
+        :param owner:           owner name
+        :param repo_id:         repository id
+        :param references:      data frame with the columns addressee_id, comment_id, ref_type, thread_type and
+                                rule_set
+        :return:                --
+        """
+        if references.empty:
+            return
+
+        frame = references[columns[2:]].copy()
+        frame.insert(0, "repo_id", repo_id)
+        frame.insert(0, "owner", owner)
+
+        self._pending.append(((owner, repo_id), frame))
+        self._pending_rows += len(frame)
+        self._rows[(owner, repo_id)] = self._rows.get((owner, repo_id), 0) + len(frame)
+
+        if self._pending_rows >= self._batch_rows:
+            self.flush()
+
+    def commit(self, owner, repo_id):
+        """
+        Marks a repository as complete. It is recorded in the ledger with the next write.
+
+        :param owner:           owner name
+        :param repo_id:         repository id
+        :return:                --
+        """
+        self._pending.append(((owner, repo_id), None))
+
+    def flush(self):
+        """writes all pending relations and records the committed repositories in the ledger"""
+        last_commit = max((i for i, (_, frame) in enumerate(self._pending) if frame is None), default=-1)
+
+        committed = self._pending[:last_commit + 1]
+        uncommitted = self._pending[last_commit + 1:]
+
+        if committed:
+            commits = self._write_pending(committed)
+            self._sync()
+
+            # relations of a repository may have been written by an earlier flush already. Its span starts there.
+            for repo, (start_offset, end_offset) in commits:
+                rows = self._rows.pop(repo, 0)
+                if self._ledger is not None:
+                    self._ledger.record(repo[0], repo[1], rows, self._path, start_offset, end_offset)
+
+        if uncommitted:
+            self._write_pending(uncommitted)
+            self._file.flush()
+
+        self._pending = []
+        self._pending_rows = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self.flush()
+        self._file.close()
+
+    def _write_pending(self, pending):
+        """
+        writes pending frames. Consecutive frames of the same repository are written at once.
+
+        :param pending:     list of pending (repository, frame) tuples
+        :return:            list of (repository, (start offset, end offset)) tuples of the commits in pending
+        """
+        commits = []
+
+        repo, frames = None, []
+        for key, frame in pending:
+            if frame is not None and key == repo:
+                frames.append(frame)
+                continue
+
+            self._write_frames(repo, frames)
+
+            if frame is None:
+                position = self._file.tell()
+                commits.append((key, self._spans.pop(key, (position, position))))
+                repo, frames = None, []
+            else:
+                repo, frames = key, [frame]
+
+        self._write_frames(repo, frames)
+
+        return commits
+
+    def _write_frames(self, repo, frames):
+        if not frames:
+            return
+
+        frame = pd.concat(frames, ignore_index=True)
+
+        start_offset = self._file.tell()
+        if self._format == "csv":
+            self._file.write(frame.to_csv(header=False, index=False).encode())
+        else:
+            self._file.write(_encode_arrow(frame, self._schema))
+
+        self._spans[repo] = (self._spans.get(repo, (start_offset,))[0], self._file.tell())
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def merge_relations(paths, target, relations_format="csv"):
+    """
+    Concatenates relations files. Missing files are skipped. The target is replaced once the merge is complete.
+
+    :param paths:               relations files in output order
+    :param target:              merged relations file
+    :param relations_format:    "csv" or "arrow"
+    :return:                    --
+    """
+    temp_file = target + ".tmp"
+
+    with open(temp_file, 'wb') as out_f:
+        if relations_format == "csv":
+            out_f.write((",".join(columns) + "\n").encode())
+
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as in_f:
+                if relations_format == "csv":
+                    in_f.readline()
+                shutil.copyfileobj(in_f, out_f)
+
+    os.replace(temp_file, target)
+
+
+def read_relations(path, relations_format="csv") -> pd.DataFrame:
+    """
+    :param path:                relations file
+    :param relations_format:    "csv" or "arrow"
+    :return:                    data frame with one relation per row
+    """
+    if relations_format == "csv":
+        return pd.read_csv(path, dtype={"owner": str})
+
+    import pyarrow as pa
+
+    tables = []
+    size = os.path.getsize(path)
+    with pa.OSFile(path, 'rb') as f:
+        while f.tell() < size:
+            tables.append(pa.ipc.open_stream(f).read_all())
+
+    if not tables:
+        return _arrow_schema().empty_table().to_pandas()
+
+    return pa.concat_tables(tables).to_pandas()
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema([("owner", pa.string()),
+                      ("repo_id", pa.int64()),
+                      ("addressee_id", pa.int64()),
+                      ("comment_id", pa.int64()),
+                      ("ref_type", pa.dictionary(pa.int8(), pa.string())),
+                      ("thread_type", pa.dictionary(pa.int8(), pa.string())),
+                      ("rule_set", pa.dictionary(pa.int8(), pa.string()))])
+
+
+def _encode_arrow(frame, schema):
+    """
+    :param frame:       relations data frame
+    :param schema:      arrow schema of the relations
+    :return:            complete Arrow IPC stream containing the relations
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue()
@@ -0,0 +1,131 @@
+"""
+MODULE: rules
+
+Declares the rule sets reference detection is based on and evaluates them in a single pass over the comments of a
+thread.
+
+A rule set is a list of rules. Explicit rules detect references in the tokens of a single comment, e.g. mentions and
+quotes. The contextual rule detects contextual replies, taking into account the explicit references the same rule
+set found in the comment. Every explicit rule is evaluated once per comment, no matter how many rule sets use it.
+
+CLASSES:
+    RuleSet
+    RulesEngine
+
+FUNCTIONS:
+    get_rule_sets
+    get_settings
+"""
+import conf as conf
+from classes.contextuals import ContextualDetector
+
+# changes whenever a rule changes its results. References stored by earlier runs are outdated then.
+version = 2
+
+# explicit rules and the Thread methods implementing them. Each method takes the position of the comment in the
+# thread and its CommentTokens and returns a list of references.
+explicit_rules = {"mention": "_detect_mentions_in_row",
+                  "quote": "_detect_quotes_in_row"}
+
+contextual_rule = "contextual"
+
+
+class RuleSet:
+    """named list of rules"""
+
+    __slots__ = ["name", "rules"]
+
+    def __init__(self, name, rules):
+        """
+        :param name:        name of the rule set. Relations are tagged with it
+        :param rules:       list of rule names, see explicit_rules and contextual_rule
+        """
+        for rule in rules:
+            if rule not in explicit_rules and rule != contextual_rule:
+                raise ValueError("unknown rule '{0}' in rule set '{1}'".format(rule, name))
+
+        self.name = name
+        self.rules = list(rules)
+
+
+# relaxed: explicit references and contextual replies
+# strict: explicit references only
+rule_sets = {"relaxed": RuleSet("relaxed", ["mention", "quote", contextual_rule]),
+             "strict": RuleSet("strict", ["mention", "quote"])}
+
+
+def get_rule_sets(names) -> list:
+    """
+    :param names:       names of rule sets declared in rule_sets
+    :return:            list of RuleSet objects
+    """
+    unknown = [name for name in names if name not in rule_sets]
+    if unknown:
+        raise ValueError("unknown rule sets {0}, use any of {1}".format(unknown, list(rule_sets)))
+
+    return [rule_sets[name] for name in names]
+
+
+def get_settings(names) -> str:
+    """
+    :param names:       names of the active rule sets
+    :return:            string describing the settings reference detection depends on besides the rules themselves
+    """
+    return "{0}|{1}|{2}".format(",".join(names), conf.nc_fuzzy_quotes, conf.nc_fuzzy_threshold)
+
+
+class RulesEngine:
+    """evaluates rule sets on the comments of a single thread. Comments have to be passed in thread order, since
+    contextual replies depend on the previous comments."""
+
+    def __init__(self, thread, active_rule_sets, detector_states=None):
+        """
+        :param thread:              Thread the comments belong to
+        :param active_rule_sets:    list of RuleSet objects
+        :param detector_states:     list with a contextual detector state per rule set as returned by
+                                    get_detector_states, if the thread is continued
+        """
+        self._rule_sets = active_rule_sets
+
+        rules = []
+        for rule_set in active_rule_sets:
+            rules.extend(rule for rule in rule_set.rules if rule in explicit_rules and rule not in rules)
+        self._explicit_rules = [(rule, getattr(thread, explicit_rules[rule])) for rule in rules]
+
+        self._detect_contextual = thread._detect_contextual_in_row
+        self._detectors = [ContextualDetector() if contextual_rule in rule_set.rules else None
+                           for rule_set in active_rule_sets]
+
+        if detector_states is not None:
+            for detector, state in zip(self._detectors, detector_states):
+                if detector is not None and state is not None:
+                    detector.set_state(*state)
+
+    def get_detector_states(self):
+        """
+        :return:            list with the state of the contextual detector of each rule set or None for rule sets
+                            without the contextual rule
+        """
+        return [detector.get_state() if detector is not None else None for detector in self._detectors]
+
+    def evaluate(self, index, tokens):
+        """
+        :param index:       position of the comment in the thread
+        :param tokens:      CommentTokens of the comment
+        :return:            list with the references found by each rule set, in the order of the rule sets
+        """
+        found = {rule: detect(index, tokens) for rule, detect in self._explicit_rules}
+
+        results = []
+        for rule_set, detector in zip(self._rule_sets, self._detectors):
+            references = []
+            for rule in rule_set.rules:
+                if rule in found:
+                    references.extend(found[rule])
+
+            if detector is not None:
+                references.extend(self._detect_contextual(index, detector, references))
+
+            results.append(references)
+
+        return results
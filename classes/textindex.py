@@ -0,0 +1,221 @@
+"""
+MODULE: textindex
+
+Index structures for looking up quoted strings in the previous comments of a thread.
+
+CLASSES:
+    SubstringIndex
+    MinHashIndex
+"""
+import zlib
+
+import numpy as np
+
+# mersenne prime used for the MinHash permutations
+_prime = (1 << 31) - 1
+
+
+class SubstringIndex:
+    """n-gram index over a sequence of documents, which answers which document is the first one to contain a string.
+
+    Documents are added in order. Every gram of length gram_length is mapped to the ascending list of documents
+    it occurs in. A query picks the gram of the query string with the shortest posting list and verifies its
+    candidates in order, so only documents sharing all grams with the query are searched. Strings shorter than
+    gram_length are searched in all documents."""
+
+    def __init__(self, gram_length=6):
+        self._gram_length = gram_length
+        self._documents = []
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, document):
+        """
+        Appends a document to the index.
+
+        :param document:    document string
+        :return:            position of the document in the index
+        """
+        if not isinstance(document, str):
+            document = str(document)
+
+        position = len(self._documents)
+        self._documents.append(document)
+
+        k = self._gram_length
+        postings = self._postings
+        for gram in {document[i:i + k] for i in range(len(document) - k + 1)}:
+            documents = postings.get(gram)
+            if documents is None:
+                postings[gram] = [position]
+            else:
+                documents.append(position)
+
+        return position
+
+    def find_first(self, string, stop=None):
+        """
+        :param string:      string to search for
+        :param stop:        only documents before this position are considered. Defaults to all documents
+        :return:            position of the first document containing string or -1
+        """
+        if stop is None or stop > len(self._documents):
+            stop = len(self._documents)
+
+        k = self._gram_length
+        if len(string) < k:
+            candidates = range(stop)
+        else:
+            candidates = None
+            for i in range(len(string) - k + 1):
+                documents = self._postings.get(string[i:i + k])
+                if documents is None:
+                    return -1
+                if candidates is None or len(documents) < len(candidates):
+                    candidates = documents
+
+        for position in candidates:
+            if position >= stop:
+                break
+            if string in self._documents[position]:
+                return position
+
+        return -1
+
+
+class MinHashIndex:
+    """MinHash sketches of the lines of a sequence of documents, which answers which document is the first one to
+    contain a line similar to a string.
+
+    Each line is shingled into character n-grams and sketched once when its document is added. The sketches are
+    split into bands, and each band is hashed into a bucket (locality sensitive hashing). A query only compares
+    its sketch with lines sharing at least one bucket. The Jaccard similarity of two lines is estimated by the
+    share of equal sketch values. Lines are cut to line_length characters, since quotes are cut as well.
+
+    Lines with similarity s share a bucket with probability 1 - (1 - s^rows)^bands. The number of bands and rows
+    per band is derived from the similarity threshold, so that the steepest rise of this curve, at about
+    (1 / bands)^(1 / rows), is just below the threshold. Lines which are much less similar than the threshold are
+    rarely compared."""
+
+    def __init__(self, threshold, num_perm=32, shingle_length=3, line_length=60, seed=1):
+        """
+        :param threshold:       minimum estimated Jaccard similarity between a string and a line
+        :param num_perm:        number of MinHash permutations
+        :param shingle_length:  length of the character n-grams
+        :param line_length:     lines are cut to this many characters
+        :param seed:            seed of the permutations
+        """
+        random_state = np.random.RandomState(seed)
+        self._a = random_state.randint(1, _prime, size=num_perm).astype(np.int64)
+        self._b = random_state.randint(0, _prime, size=num_perm).astype(np.int64)
+
+        self._threshold = threshold
+        self._bands, self._rows = self._get_banding(threshold, num_perm)
+        self._shingle_length = shingle_length
+        self._line_length = line_length
+
+        self._no_documents = 0
+        self._line_documents = []
+        self._line_sketches = []
+        self._buckets = {}
+
+    def __len__(self):
+        return self._no_documents
+
+    def add(self, document):
+        """
+        Appends a document to the index.
+
+        :param document:    document string
+        :return:            position of the document in the index
+        """
+        if not isinstance(document, str):
+            document = str(document)
+
+        position = self._no_documents
+        self._no_documents += 1
+
+        for line in document.splitlines():
+            sketch = self._sketch(line.strip()[:self._line_length])
+            if sketch is None:
+                continue
+
+            line_id = len(self._line_sketches)
+            self._line_sketches.append(sketch)
+            self._line_documents.append(position)
+
+            for key in self._band_keys(sketch):
+                lines = self._buckets.get(key)
+                if lines is None:
+                    self._buckets[key] = [line_id]
+                else:
+                    lines.append(line_id)
+
+        return position
+
+    def find_first(self, string, stop=None):
+        """
+        :param string:      string to search for
+        :param stop:        only documents before this position are considered. Defaults to all documents
+        :return:            position of the first document containing a line similar to string or -1
+        """
+        if stop is None:
+            stop = self._no_documents
+
+        sketch = self._sketch(string.strip()[:self._line_length])
+        if sketch is None:
+            return -1
+
+        candidates = set()
+        for key in self._band_keys(sketch):
+            candidates.update(self._buckets.get(key, ()))
+
+        # line ids ascend with the document position, so the first confirmed candidate is the first document
+        for line_id in sorted(candidates):
+            position = self._line_documents[line_id]
+            if position >= stop:
+                break
+            if np.mean(self._line_sketches[line_id] == sketch) >= self._threshold:
+                return position
+
+        return -1
+
+    @staticmethod
+    def _get_banding(threshold, num_perm):
+        """
+        :param threshold:   minimum similarity
+        :param num_perm:    number of MinHash permutations
+        :return:            tuple of bands and rows per band, using at most num_perm sketch values, with the largest
+                            approximate LSH threshold (1 / bands)^(1 / rows) not above threshold. On a tie, more
+                            bands and then more rows are preferred.
+        """
+        best = (0.0, num_perm, 1)
+        for rows in range(1, num_perm + 1):
+            for bands in range(1, num_perm // rows + 1):
+                lsh_threshold = (1.0 / bands) ** (1.0 / rows)
+                if lsh_threshold <= threshold and (lsh_threshold, bands, rows) > best:
+                    best = (lsh_threshold, bands, rows)
+
+        return best[1], best[2]
+
+    def _sketch(self, text):
+        """
+        :param text:    string
+        :return:        MinHash signature of the string's shingles or None, if the string is too short
+        """
+        k = self._shingle_length
+        if len(text) < k:
+            return None
+
+        shingles = {text[i:i + k] for i in range(len(text) - k + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles),
+                             dtype=np.int64,
+                             count=len(shingles))
+
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _prime).min(axis=1)
+
+    def _band_keys(self, sketch):
+        rows = self._rows
+        return [(band, sketch[band * rows:(band + 1) * rows].tobytes()) for band in range(self._bands)]
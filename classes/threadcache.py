@@ -0,0 +1,147 @@
+"""
+MODULE: threadcache
+
+On-disk cache of the candidate references found in threads, so that threads which did not change since the last
+run don't have to be processed again.
+
+CLASSES:
+    ThreadCache
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import classes.rules as rules
+
+# changes whenever the format of the stored records changes
+_record_format = 2
+
+
+class ThreadCache:
+    """sqlite backed cache of thread results, one database per owner.
+
+    Entries are keyed by a hash over the record format, the thread type, the rules version, the detection settings
+    and the sequence of (comment_id, actor_id, comment_body) of the thread's comments. A thread which gained, lost or
+    changed a comment therefore gets a new key. Entries hold the thread's candidate mentions and quotes before
+    validation, with actors stored as actor ids, since actor keys are only valid within a run.
+
+    Entries which have not been used for max_age_days are evicted when the cache is closed. If the cache is larger
+    than max_mb afterwards, the least recently used entries are evicted as well."""
+
+    def __init__(self, path, max_age_days=180, max_mb=1024):
+        """
+        :param path:            database file, created if it does not exist
+        :param max_age_days:    entries not used for this many days are evicted
+        :param max_mb:          maximum size of all entries in megabytes
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self._max_age = max_age_days * 24 * 3600
+        self._max_bytes = max_mb * 1024 * 1024
+
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS threads ("
+                                 "key TEXT PRIMARY KEY, "
+                                 "refs BLOB NOT NULL, "
+                                 "size INTEGER NOT NULL, "
+                                 "used REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS threads_used ON threads (used)")
+
+        self._now = time.time()
+        self._inserts = []
+        self._hits = []
+
+        self.no_hits = 0
+        self.no_misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def make_key(thread_type, settings, comment_ids, actor_ids, bodies):
+        """
+        :param thread_type:     'pullreq', 'issue' or 'commit'
+        :param settings:        string describing every setting the results depend on, e.g. the active rule sets
+        :param comment_ids:     comment ids of the thread in thread order
+        :param actor_ids:       actor ids of the commenters
+        :param bodies:          comment bodies
+        :return:                cache key
+        """
+        digest = hashlib.sha1("{0}\x1e{1}\x1e{2}\x1e{3}\x1e".format(_record_format, rules.version, thread_type,
+                                                                 settings).encode())
+        for comment_id, actor_id, body in zip(comment_ids, actor_ids, bodies):
+            digest.update("{0}\x1f{1}\x1f{2}\x1e".format(comment_id, actor_id, body).encode())
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        :param key:     cache key
+        :return:        list of reference records stored for the key or None
+        """
+        row = self._connection.execute("SELECT refs FROM threads WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self._hits.append((self._now, key))
+        return json.loads(zlib.decompress(row[0]).decode())
+
+    def put(self, key, records):
+        """
+        :param key:         cache key
+        :param records:     list of reference records, which have to be JSON serializable
+        :return:            --
+        """
+        blob = zlib.compress(json.dumps(records, separators=(",", ":")).encode())
+        self._inserts.append((key, blob, len(blob), self._now))
+
+    def count(self, hit):
+        """counts a lookup as hit or miss"""
+        if hit:
+            self.no_hits += 1
+        else:
+            self.no_misses += 1
+
+    def commit(self):
+        """writes new entries and access times to disk"""
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO threads (key, refs, size, used) VALUES (?, ?, ?, ?)",
+                                         self._inserts)
+            self._connection.executemany("UPDATE threads SET used = ? WHERE key = ?", self._hits)
+
+        self._inserts = []
+        self._hits = []
+
+    def evict(self):
+        """removes entries which have not been used for max_age_days and the least recently used entries
+        exceeding max_mb"""
+        with self._connection:
+            self._connection.execute("DELETE FROM threads WHERE used < ?", (self._now - self._max_age,))
+
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM threads").fetchone()[0]
+            if total > self._max_bytes:
+                excess = total - self._max_bytes
+                evicted = []
+                for key, size in self._connection.execute("SELECT key, size FROM threads ORDER BY used"):
+                    evicted.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._connection.executemany("DELETE FROM threads WHERE key = ?", evicted)
+
+    def close(self):
+        if self._connection is None:
+            return
+
+        self.commit()
+        self.evict()
+        self._connection.close()
+        self._connection = None
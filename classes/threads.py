@@ -1,157 +1,118 @@
-import pandas as pd
+from bisect import bisect_left, bisect_right
 
-import classes.collectors as collectors
 import conf as conf
-from classes.references import Mention, Quote, ContextualReply
+from classes.contextuals import ContextualDetector
+from classes.references import Mention, Quote, ContextualReply, reference_classes
+from classes.rules import RulesEngine, contextual_rule
+from classes.textindex import SubstringIndex, MinHashIndex
+from classes.tokenizer import tokenize
+
+
+class ThreadComments:
+    """array-backed representation of the comments in a thread. Holds one plain list per column, so that the
+    reference detectors can access single comments by position without pandas overhead. Actors are stored as
+    keys of the owner's ActorRegistry."""
+
+    __slots__ = ["actor_keys", "comment_ids", "bodies"]
+
+    def __init__(self, thread_data):
+        self.actor_keys = thread_data["actor_key"].tolist()
+        self.comment_ids = thread_data["comment_id"].tolist()
+        self.bodies = thread_data["comment_body"].tolist()
+
+    def __len__(self):
+        return len(self.comment_ids)
 
 
 class Thread:
-    """contains a communication thread and its thread analytics"""
+    """contains a communication thread and its thread analytics.
+    thread_data is expected to be sorted by comment_id."""
 
-    def __init__(self, thread_data, thread_type, project_stats, parent_project):
+    # maximum length of a quote, counted from the quote marker
+    _quote_cut = 60
 
-        self._thread_data = thread_data.sort_values(by="comment_id", axis="rows", ascending=True)
-        self.no_comments = len(self._thread_data)
+    def __init__(self, thread_data, thread_type, project_stats, parent_project):
 
-        self.owner = "fooOwner"  # TODO: remove support for thread owners
-        # connection between first commenter and thread owner is implemented
-        # with a cypher script
+        self._thread_data = thread_data
+        self._comments = ThreadComments(thread_data)
+        self.no_comments = len(self._comments)
 
         self._type = thread_type
         self.parent_project = parent_project
+        self._reference_buffer = parent_project.get_reference_buffer()
 
-        self._participants = (self._thread_data["actor_id"]).unique()
+        self._participants = frozenset(self._comments.actor_keys)
+        self._thread_no = self._reference_buffer.add_thread(self._participants)
 
-        self._actor_dict = (pd.concat([self._thread_data["actor_id"],
-                                      self._thread_data["actor_login"].str.lower()],
-                                      axis="columns"))\
-            .set_index('actor_login')\
-            .to_dict()\
-            .get('actor_id')
-
-        self._references_strict = None
-        self._references_relaxed = None
+        self._quote_index = None
+        self._fuzzy_quote_index = None
 
         self._project_stats = project_stats
         self._project_stats.add_thread()
         self._project_stats.add_comments(len(self._thread_data))
 
     def run(self):
-        self._references_relaxed = self._find_references_relaxed()
+        """finds the thread's candidate references and appends them to the project's reference buffer. In
+        incremental mode, only comments after the thread's high-water mark are processed. Otherwise, if the project
+        has a thread cache, the references are taken from the cache, if the thread did not change."""
+        thread_states = self.parent_project.get_thread_states()
+        cache = self.parent_project.get_thread_cache()
+        if thread_states is not None:
+            results = self._continue_references(thread_states)
+        elif cache is None:
+            results = self._find_references()
+        else:
+            key = cache.make_key(self._type,
+                                 self.parent_project.get_detection_settings(),
+                                 self._comments.comment_ids,
+                                 self._thread_data["actor_id"].tolist(),
+                                 self._comments.bodies)
 
-    # -------- getters --------
-    def get_references(self, which):
+            records = cache.get(key)
+            results = self._restore_references(records) if records is not None else None
+            cache.count(results is not None)
 
-        if which == "strict":
-            result = self._references_strict
-        elif which == "relaxed":
-            result = self._references_relaxed
-        else:
-            raise ValueError("Parameter 'which' not set correctly \n"
-                             "Specify, which references ('relaxed' or 'strict') should"
-                             "be returned!")
-        return result
-
-    def get_references_as_list(self):
-        ref_list = []
-        if self._references_relaxed:
-            for reference in self._references_relaxed:
-                ref_dict = reference.get_info_as_dict()
-                if ref_list:
-                    ref_list.append(ref_dict)
-                else:
-                    ref_list = [ref_dict]
-
-        return ref_list
+            if results is None:
+                results = self._find_references()
+                cache.put(key, self._store_references(results))
+
+        for rule_set, references in enumerate(results):
+            self._reference_buffer.extend(self._thread_no, references, rule_set)
 
+    # -------- getters --------
     def get_participants(self):
         return self._participants
 
     # -------- is ---------
-    def is_participant(self, name):
-        return name in self._participants
+    def is_participant(self, key):
+        return key in self._participants
 
-    @staticmethod
-    def _is_quote(sequence, position):
+    def _is_valid(self, reference):
         """
-        recursively check if > can define a quote or if it is something else.
-        Search begins with the last > found in the body string.
-
-        > defines a quote, ...
-        ... if it is preceeded by \r\n
-        ... if it occurs at position 0
-
-        If the result is false, we know for sure that the > does not define a quote.
-        However, if the result is true, it could introduce a quote but also close an html tag
-        Therefore, we check if we can find the string behind the > in one of the pre-
-        vious comments later.
-
-        :param sequence:        body string
-        :param position:        > position
-        :return:                true or false
+        :param reference:   candidate reference
+        :return:            true, if the reference is resolved, not a self reference and addressed to a project
+                            participant, as checked by the project's validation
         """
-        if position >= 2 and sequence[position - 2:position] == "\r\n":
-            return True
-        elif position >= 1 and sequence[position - 1:position] == ">":
-            return Thread._is_quote(sequence, position - 1)
-        elif position == 0:
-            return True
-        else:
-            return False
+        return reference.is_resolved() and self.parent_project.is_participant(reference.addressee_key)
 
-    @staticmethod
-    def _clear_markdown_close(md_list):
-        """
-        Remove all > which are immediately followed by another >
-
-        :param md_list:
-        :return:
-        """
-        md_list.sort()
-        cleared_md_list = []
-        distance = 1
-
-        if not md_list:
-            return []
-        elif len(md_list) == 1:
-            cleared_md_list = md_list
-        else:
-            for i in range(1, len(md_list)):
-                if md_list[i] - md_list[i - 1] > distance:
-                    if cleared_md_list:
-                        cleared_md_list.append(md_list[i - 1])
-                    else:
-                        cleared_md_list = [md_list[i - 1]]
-
-            cleared_md_list.append(md_list[len(md_list) - 1])
-        return cleared_md_list
-
-    def _detect_mentions_in_row(self, row):
+    def _detect_mentions_in_row(self, index, tokens):
         mentions_list = []
 
-        body = row["comment_body"]
-        commenter_id = row["actor_id"]
-        comment_id = row["comment_id"]
+        body = tokens.body
+        commenter_key = self._comments.actor_keys[index]
+        comment_id = self._comments.comment_ids[index]
 
-        start_pos_list = self._find_all(body, "@")
-        for start_pos in start_pos_list:
-            stop_pos = Thread._find_end_username(body, start_pos)
+        for start_pos, stop_pos in tokens.mentions:
 
             addressee_login = str.lower(body[start_pos + 1:stop_pos])
             # search for lowercase username, since users might not type their mentions case sensitively
 
-            mention = Mention(commenter_id,
-                              addressee_login,
-                              comment_id,
-                              self,
-                              self._project_stats,
-                              self._type)
-            mention.set_start_pos(start_pos)
-
-            if mentions_list:
-                mentions_list.append(mention)
-            else:
-                mentions_list = [mention]
+            mentions_list.append(Mention(commenter_key,
+                                         self.parent_project.get_actor_key(addressee_login),
+                                         comment_id,
+                                         self._type,
+                                         start_pos,
+                                         addressee_login))
 
         return mentions_list
 
@@ -159,217 +120,349 @@ class Thread:
     # seems like line break symbols \r\n are not included explicitly in the string
     # signs are included in the original data but it seems as if they are replaced during
     # data preprocessing
-    def _detect_quotes_in_row(self, row, index):
-        # TODO: source can't be found if quote was altered slightly (spelling corrected, etc.)
+    def _detect_quotes_in_row(self, index, tokens):
         quote_list = []
 
-        body = row["comment_body"]
-        commenter_id = row["actor_id"]
-        comment_id = row["comment_id"]
-
-        # filter '>' that define quotes
-        close_temp = []
-        markdown_close = self._find_all(body, ">")
-
-        # remove > that follow each other too closely
-        markdown_close = self._clear_markdown_close(markdown_close)
+        body = tokens.body
+        commenter_key = self._comments.actor_keys[index]
+        comment_id = self._comments.comment_ids[index]
 
-        # check if > found can define a quote
-        for item_pos in markdown_close:
-            if self._is_quote(body, item_pos):
-                close_temp.append(item_pos)
-
-        start_pos_list = close_temp
-        for start_pos in start_pos_list:
-            # find the end of the quote
-            stop_pos = Thread._find_end_quote(body, start_pos)
+        # a quote marker could also close an html tag. Therefore, a quote is only attributed, if the
+        # string behind the marker can be found in one of the previous comments.
+        for start_pos in tokens.quotes:
+            # find the end of the quote. quotes end with \r\n or the comment end
+            stop_pos = min(tokens.line_end(start_pos), start_pos + self._quote_cut)
             # don't consider the first 5 values
             quote_body = body[start_pos + 5:stop_pos]
             # find the quote string in previous comments
-            addressee_id = self._find_source(quote_body, index)
-
-            new_quote = Quote(commenter_id, addressee_id, comment_id, self, self._project_stats, self._type)
-            new_quote.set_start_pos(start_pos)
+            addressee_key = self._find_source(quote_body, index)
+            if addressee_key is None and conf.nc_fuzzy_quotes:
+                addressee_key = self._find_source_fuzzy(quote_body, index)
 
-            if quote_list:
-                quote_list.append(new_quote)
-            else:
-                quote_list = [new_quote]
+            quote_list.append(Quote(commenter_key, addressee_key, comment_id, self._type, start_pos))
 
         return quote_list
 
-    def _detect_contextuals(self, mentions, m_indices, quotes, q_indices):
+    def _detect_contextual_in_row(self, index, detector, explicit_references):
+        """
+        :param index:                   position of the comment in the thread
+        :param detector:                ContextualDetector which has been fed all previous comments
+        :param explicit_references:     explicit references the rule set found in the comment
+        :return:                        list containing the contextual reply or an empty list
+        """
+        commenter_key = self._comments.actor_keys[index]
 
-        contextuals_list = []
-        comment_sequence = self._thread_data["actor_id"]
-        m_i = 0
-        q_i = 0
+        # only valid references count
+        valid_references = [reference for reference in explicit_references if self._is_valid(reference)]
+        addressees = {reference.addressee_key for reference in valid_references}
+        leading = any(reference.start_pos == 0 for reference in valid_references)
 
-        for r in range(0, len(comment_sequence)):
+        addressee_key = detector.feed(commenter_key, addressees, leading)
+        if addressee_key is None:
+            return []
 
-            new_contextual = None
+        return [ContextualReply(commenter_key,
+                                addressee_key,
+                                self._comments.comment_ids[index],
+                                self._type)]
 
-            u_prev = self.owner
-            if r > 0:
-                u_prev = comment_sequence[r - 1]
+    def _find_references(self, start=0, engine=None):
+        """
+        finds references in the thread according to the project's rule sets. The candidates are validated by the
+        project.
 
-            u_current = comment_sequence[r]
+        :param start:   position of the first comment to search for references
+        :param engine:  RulesEngine which has been fed the comments before start. Defaults to a new engine
+        :return:        list with the references found by each rule set, in the order of the project's rule sets
+        """
+        if engine is None:
+            engine = RulesEngine(self, self.parent_project.get_rule_sets())
+        results = [[] for _ in self.parent_project.get_rule_sets()]
 
-            comment_id = self._thread_data["comment_id"].iloc[r]
+        for index in range(start, len(self._comments)):
+            tokens = tokenize(self._comments.bodies[index])
 
-            if len(comment_sequence[0:r].unique()) > 2 and mentions and quotes:
-                if m_indices[r] > 0 or q_indices[r] > 0:
+            for references, found in zip(results, engine.evaluate(index, tokens)):
+                references.extend(found)
 
-                    create = True
+        return results
 
-                    i = 0
-                    while create and i < m_indices[r]:
-                        if mentions[m_i + i].get_start_pos() == 0 or mentions[m_i + i].addressee_id == u_prev:
-                            create = False
-                        i += 1
+    # -------- incremental mode --------
+    def _continue_references(self, thread_states):
+        """
+        finds references in the comments which arrived after the thread's high-water mark and stores the new
+        thread state. Previous comments are only used as quote sources. Pending mentions of previous runs are
+        validated again, the ones which became valid are returned along with the new references.
 
-                    m_i += m_indices[r]
+        :param thread_states:   owner's ThreadStateStore
+        :return:                list with the references found by each rule set
+        """
+        project = self.parent_project
+        participants = project.get_participants()
+        thread = self._get_thread_identifier()
+        comment_ids = self._comments.comment_ids
 
-                    i = 0
-                    while create and i < q_indices[r]:
-                        if quotes[q_i + i].get_start_pos() == 0 or quotes[q_i + i].addressee_id == u_prev:
-                            create = False
-                        i += 1
+        results = [[] for _ in project.get_rule_sets()]
 
-                    q_i += q_indices[r]
+        start = 0
+        watermark = None
+        stored_states = None
+        pending = []
+        stored = thread_states.get(thread)
+        if stored is not None:
+            watermark, stored_states, pending = stored
+            start = bisect_right(comment_ids, watermark)
 
-                    if create:
-                        new_contextual = ContextualReply(u_current, u_prev, comment_id, self, self._project_stats,
-                                                          self._type)
+        if start == len(comment_ids) and not pending:
+            return results
 
-                else:
-                    new_contextual = ContextualReply(u_current, u_prev, comment_id, self, self._project_stats,
-                                                      self._type)
-            else:
-                if u_current == u_prev:
-                    pass
-                else:
-                    new_contextual = ContextualReply(u_current, u_prev, comment_id, self, self._project_stats,
-                                                      self._type)
+        pending, changed = self._revalidate_pending(pending, results)
 
-            if contextuals_list and new_contextual is not None:
-                contextuals_list.append(new_contextual)
-            elif new_contextual is not None:
-                contextuals_list = [new_contextual]
+        if start < len(comment_ids):
+            detector_states = None
+            if stored_states is not None:
+                detector_states = [self._convert_detector_state(state, participants.get_keys)
+                                   for state in stored_states]
 
-        return contextuals_list
+            engine = RulesEngine(self, project.get_rule_sets(), detector_states)
+            found = self._find_references(start, engine)
+            for references, new_references in zip(results, found):
+                references.extend(new_references)
 
-    @staticmethod
-    def _remove_invalid_references(reference_list):
+            pending.extend(self._get_pending(found))
+            watermark = comment_ids[-1]
+            stored_states = [self._convert_detector_state(state,
+                                                          lambda keys: participants.get_actor_ids(keys).tolist())
+                             for state in engine.get_detector_states()]
 
-        ind_invalid = []
-        for i in range(0, len(reference_list)):
-            if not reference_list[i].is_valid():
-                if ind_invalid:
-                    ind_invalid.append(i)
-                else:
-                    ind_invalid = [i]
+        elif not changed:
+            # no new comments and the pending mentions are unchanged
+            return results
 
-        for i in sorted(ind_invalid, reverse=True):
-            if conf.collect_invalid:
-                collectors.add_invalid_reference(reference_list[i])
+        thread_states.put(thread, watermark, stored_states, pending)
 
-            del reference_list[i]
-        return reference_list
+        return results
 
-    @staticmethod
-    def _consolidate_references(mentions, quotes, contextuals):
-        reference_list = mentions + quotes + contextuals
+    def _get_pending(self, results):
+        """
+        :param results:     list with the references found by each rule set
+        :return:            list of pending mention records [rule set, comment id, replied, [[start position,
+                            login], ...]], one per rule set and comment with pending mentions. replied is true, if
+                            the rule set found a valid contextual reply in the comment
+        """
+        records = []
+        for rule_set, references in enumerate(results):
+            replied = {reference.comment_id for reference in references
+                       if isinstance(reference, ContextualReply) and self._is_valid(reference)}
 
-        return reference_list
+            mentions = {}
+            for reference in references:
+                if isinstance(reference, Mention) and not self._is_valid(reference) \
+                        and reference.addressee_key != reference.commenter_key:
+                    mentions.setdefault(reference.comment_id, []).append([reference.start_pos,
+                                                                          reference.addressee_login])
 
-    def _find_references_relaxed(self):
-        """finds references in the thread according to the relaxed rule set"""
-        all_mentions = []
-        all_quotes = []
+            for comment_id, comment_mentions in mentions.items():
+                records.append([rule_set, comment_id, comment_id in replied, comment_mentions])
 
-        mentions_indices = []
-        quotes_indices = []
+        return records
 
-        for index in range(0, len(self._thread_data)):
-            row = self._thread_data.iloc[index]
+    def _revalidate_pending(self, pending, results):
+        """
+        resolves the logins of pending mentions again and validates them against the current project participants.
+        Mentions which became valid are added to the results.
+
+        A mention which became valid would have suppressed the contextual reply found in its comment, if it opens
+        the comment or mentions the previous commenter. The reply has been written by an earlier run and can't be
+        taken back, it is counted as superseded in the project stats.
+
+        :param pending:     list of pending mention records as returned by _get_pending
+        :param results:     list with the references found by each rule set, extended with the valid mentions
+        :return:            tuple with the list of the pending mention records which are still pending and a flag,
+                            which is true if the records changed, i.e. a mention was emitted, dropped or a replied
+                            flag was reset. The thread state has to be stored again in that case
+        """
+        project = self.parent_project
+        comment_ids = self._comments.comment_ids
+        actor_keys = self._comments.actor_keys
+
+        remaining = []
+        for rule_set, comment_id, replied, mentions in pending:
+            index = bisect_left(comment_ids, comment_id)
+            if index == len(comment_ids) or comment_ids[index] != comment_id:
+                continue
+
+            commenter_key = actor_keys[index]
+            # the reply could only be suppressed, if the thread had more than two participants before the comment
+            suppressible = replied and len(set(actor_keys[:index])) > 2
+
+            still_pending = []
+            for start_pos, login in mentions:
+                mention = Mention(commenter_key, project.get_actor_key(login), comment_id, self._type, start_pos,
+                                  login)
+
+                if self._is_valid(mention):
+                    results[rule_set].append(mention)
+                    if suppressible and (start_pos == 0 or mention.addressee_key == actor_keys[index - 1]):
+                        self._project_stats.add_superseded_contextual()
+                        replied = suppressible = False
+                elif mention.addressee_key != commenter_key:
+                    still_pending.append([start_pos, login])
+
+            if still_pending:
+                remaining.append([rule_set, comment_id, replied, still_pending])
+
+        return remaining, remaining != pending
+
+    def _get_thread_identifier(self):
+        """
+        :return:    string identifying the thread within the owner's data
+        """
+        first = self._thread_data.iloc[0]
+        if self._type in ["pullreq", "commit"]:
+            return "{0}/{1}/{2}/{3}".format(self.parent_project.repo, self._type, first["thread_id"],
+                                            first["comment_position"])
+        return "{0}/{1}/{2}".format(self.parent_project.repo, self._type, first["thread_id"])
 
-            mentions = self._detect_mentions_in_row(row)
-            mentions = self._remove_invalid_references(mentions)
+    @staticmethod
+    def _convert_detector_state(state, convert):
+        """
+        :param state:       detector state as tuple of participants and previous commenter or None
+        :param convert:     function converting a list of actors, from actor ids to actor keys or vice versa
+        :return:            converted state
+        """
+        if state is None:
+            return None
 
-            quotes = self._detect_quotes_in_row(row, index)
-            quotes = self._remove_invalid_references(quotes)
+        participants, previous = state
+        if previous is None:
+            return convert(list(participants)), None
 
-            if mentions and all_mentions:
-                all_mentions.extend(mentions)
-            elif mentions:
-                all_mentions = mentions
+        converted = convert(list(participants) + [previous])
+        return converted[:-1], converted[-1]
 
-            if mentions_indices:
-                mentions_indices.append(len(mentions))
+    # -------- thread cache --------
+    def _store_references(self, results):
+        """
+        :param results:     list with the references found by each rule set
+        :return:            list of records [rule set, type code, commenter id, addressee id, comment id, start
+                            position, addressee login] with actor ids instead of keys. Contextual replies are not
+                            stored, since they depend on the validity of the explicit references, which can change
+                            while the thread does not.
+        """
+        project = self.parent_project
+        records = []
+        for rule_set, references in enumerate(results):
+            for reference in references:
+                if isinstance(reference, ContextualReply):
+                    continue
+                addressee_key = reference.addressee_key
+                records.append([rule_set,
+                                reference.type_code,
+                                int(project.get_actor_id(reference.commenter_key)),
+                                int(project.get_actor_id(addressee_key)) if addressee_key is not None else None,
+                                reference.comment_id,
+                                reference.start_pos,
+                                getattr(reference, "addressee_login", None)])
+        return records
+
+    def _restore_references(self, records):
+        """
+        :param records:     list of records as returned by _store_references
+        :return:            list with the references found by each rule set or None, if the records are outdated.
+                            That is the case, if an actor id is unknown to the owner or a mentioned login refers to
+                            another actor than before, e.g. because the login was unknown before.
+        """
+        project = self.parent_project
+
+        actor_ids = {record[2] for record in records}
+        actor_ids.update(record[3] for record in records if record[3] is not None)
+        actor_ids = list(actor_ids)
+        keys = dict(zip(actor_ids, project.get_participants().get_keys(actor_ids)))
+
+        results = [[] for _ in project.get_rule_sets()]
+        for rule_set, type_code, commenter_id, addressee_id, comment_id, start_pos, login in records:
+            commenter_key = keys[commenter_id]
+            addressee_key = keys[addressee_id] if addressee_id is not None else None
+            if commenter_key < 0 or (addressee_key is not None and addressee_key < 0):
+                return None
+
+            if login is not None:
+                if project.get_actor_key(login) != addressee_key:
+                    return None
+                reference = reference_classes[type_code](commenter_key, addressee_key, comment_id, self._type,
+                                                         start_pos, login)
             else:
-                mentions_indices = [len(mentions)]
+                reference = reference_classes[type_code](commenter_key, addressee_key, comment_id, self._type,
+                                                         start_pos)
 
-            if quotes and all_quotes:
-                all_quotes.extend(quotes)
-            elif quotes:
-                all_quotes = quotes
+            results[rule_set].append(reference)
 
-            if quotes_indices:
-                quotes_indices.append(len(quotes))
-            else:
-                quotes_indices = [len(quotes)]
+        self._derive_contextual_replies(results)
 
-        all_contextuals = self._detect_contextuals(all_mentions, mentions_indices, all_quotes, quotes_indices)
-        all_contextuals = self._remove_invalid_references(all_contextuals)
+        return results
 
-        ref_relaxed = self._consolidate_references(all_mentions, all_quotes, all_contextuals)
+    def _derive_contextual_replies(self, results):
+        """
+        detects the contextual replies of the thread from the explicit references found before.
+
+        :param results:     list with the explicit references found by each rule set, extended with the contextual
+                            replies of rule sets which contain the contextual rule
+        :return:            --
+        """
+        for rule_set, references in zip(self.parent_project.get_rule_sets(), results):
+            if contextual_rule not in rule_set.rules:
+                continue
 
-        return ref_relaxed
+            explicit_references = {}
+            for reference in references:
+                explicit_references.setdefault(reference.comment_id, []).append(reference)
 
-    def _find_references_strict(self):
-        # TODO: implement strict rule set
-        pass
+            detector = ContextualDetector()
+            for index, comment_id in enumerate(self._comments.comment_ids):
+                references.extend(self._detect_contextual_in_row(index, detector,
+                                                                 explicit_references.get(comment_id, [])))
 
     def _find_source(self, quote, stop_row):
-        i = 0
-        while stop_row > i:
-            if self._thread_data["comment_body"].iloc[i].find(quote) > -1:
-                return self._thread_data["actor_id"].iloc[i]
-            i = i + 1
+        """
+        finds the author of the first comment before stop_row which contains the quote. The quote index is
+        extended with the comments up to stop_row on demand, so threads without quotes never build it.
 
-        return None
+        :param quote:       quoted string
+        :param stop_row:    position of the quoting comment
+        :return:            actor key or None, if the quote could not be found
+        """
+        if self._quote_index is None:
+            self._quote_index = SubstringIndex()
 
-    # --------- static string searches -------
-    @staticmethod
-    def _find_all(s, ch):
-        """find all occurrences of ch in s"""
-        try:
-            return [i for i, ltr in enumerate(s) if ltr == ch]
-        except TypeError:
-            s = str(s)
-            return Thread._find_all(s, ch)
+        bodies = self._comments.bodies
+        while len(self._quote_index) < stop_row:
+            self._quote_index.add(bodies[len(self._quote_index)])
 
-    @staticmethod
-    def _find_end_username(s, start_pos):
-        """find the position in s where the username ends. a username ends with one of the
-        characters in char_list or with the comment end"""
-        char_list = {' ', "'", '.', '@', '`', ',', "!", "?",
-                     "(", ")", "{", "}", "[", "]", "/",
-                     "\\", "\"", "\n", "\t", "\r"}
-        ind = next((i for i, ch in enumerate(s) if ch in char_list and i > start_pos + 1), len(s))
-        return ind
+        source_row = self._quote_index.find_first(quote, stop_row)
+        if source_row < 0:
+            return None
 
-    @staticmethod
-    def _find_end_quote(quote, start_pos):
-        """find the end of a quote. quotes end with \r\n or the comment end"""
+        return self._comments.actor_keys[source_row]
+
+    def _find_source_fuzzy(self, quote, stop_row):
+        """
+        finds the author of the first comment before stop_row which contains a line similar to the quote. Catches
+        quotes which were altered slightly (spelling corrected, line breaks changed, etc.).
+
+        :param quote:       quoted string
+        :param stop_row:    position of the quoting comment
+        :return:            actor key or None, if no similar line was found
+        """
+        if self._fuzzy_quote_index is None:
+            self._fuzzy_quote_index = MinHashIndex(conf.nc_fuzzy_threshold)
 
-        end = quote.find("\r\n")
-        cut_val = 60
+        bodies = self._comments.bodies
+        while len(self._fuzzy_quote_index) < stop_row:
+            self._fuzzy_quote_index.add(bodies[len(self._fuzzy_quote_index)])
 
-        if end == -1:
-            end = len(quote)
+        source_row = self._fuzzy_quote_index.find_first(quote, stop_row)
+        if source_row < 0:
+            return None
 
-        if end - start_pos > cut_val:
-            end = start_pos + cut_val
-        return end
+        return self._comments.actor_keys[source_row]
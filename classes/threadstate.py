@@ -0,0 +1,108 @@
+"""
+MODULE: threadstate
+
+Persists how far each thread has been processed, so that an incremental run only scans comments which arrived since
+the previous run.
+
+CLASSES:
+    ThreadStateStore
+"""
+import json
+import os
+import sqlite3
+
+import classes.rules as rules
+
+
+class ThreadStateStore:
+    """sqlite backed store of thread states, one database per owner.
+
+    The state of a thread consists of its high-water mark, the largest comment id processed, the state of the
+    contextual reply detectors of each rule set: the participants seen so far and the last commenter, both as actor
+    ids, and the thread's pending mentions. Pending mentions are mentions which were invalid when they were processed,
+    but may become valid later: mentions of unknown logins and of actors who don't participate in the project yet.
+    They are validated again by every incremental run. The quote index is not stored. It is rebuilt from the bodies of
+    the processed comments, which are part of the input anyway, and only for threads which receive a quote.
+
+    States depend on the rule sets and the rules version. A store can't be used with other settings than the ones it
+    was created with."""
+
+    def __init__(self, path, settings):
+        """
+        :param path:        database file, created if it does not exist
+        :param settings:    string describing the settings the states depend on, e.g. the active rule sets
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self._path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS threads ("
+                                 "thread TEXT PRIMARY KEY, "
+                                 "watermark INTEGER NOT NULL, "
+                                 "state TEXT NOT NULL, "
+                                 "pending TEXT NOT NULL)")
+
+        settings = "{0}|{1}".format(rules.version, settings)
+        row = self._connection.execute("SELECT value FROM meta WHERE name = 'settings'").fetchone()
+        if row is None:
+            with self._connection:
+                self._connection.execute("INSERT INTO meta (name, value) VALUES ('settings', ?)", (settings,))
+        elif row[0] != settings:
+            self._connection.close()
+            raise ValueError("thread states in {0} were built with settings '{1}', current settings are '{2}'. "
+                             "Remove the file and rebuild the network".format(path, row[0], settings))
+
+        self._updates = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, thread):
+        """
+        :param thread:      thread identifier
+        :return:            tuple of watermark, detector states and pending mentions or None, if the thread has not
+                            been processed
+        """
+        row = self._connection.execute("SELECT watermark, state, pending FROM threads WHERE thread = ?",
+                                       (thread,)).fetchone()
+        if row is None:
+            return None
+
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def put(self, thread, watermark, detector_states, pending):
+        """
+        Stores a thread state with the next commit.
+
+        :param thread:              thread identifier
+        :param watermark:           largest comment id processed
+        :param detector_states:     list of JSON serializable detector states, one per rule set
+        :param pending:             list of JSON serializable pending mention records
+        :return:                    --
+        """
+        self._updates.append((thread,
+                              int(watermark),
+                              json.dumps(detector_states, separators=(",", ":")),
+                              json.dumps(pending, separators=(",", ":"))))
+
+    def commit(self):
+        """writes the stored thread states to disk"""
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO threads (thread, watermark, state, pending) "
+                                         "VALUES (?, ?, ?, ?)",
+                                         self._updates)
+        self._updates = []
+
+    def close(self):
+        """closes the store. Thread states which have not been committed are discarded."""
+        if self._connection is None:
+            return
+
+        self._connection.close()
+        self._connection = None
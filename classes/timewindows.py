@@ -0,0 +1,291 @@
+"""
+MODULE: timewindows
+
+Cuts time windows out of an owner's communication links in memory and maintains the graph of a window sliding over
+them.
+
+CLASSES:
+    TemporalLinks
+    WindowGraph
+"""
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+_ms_per_day = 24 * 3600 * 1000
+
+
+class TemporalLinks:
+    """communication links of an owner as time-sorted arrays.
+
+    A window covers the length_days days before its end date, both bounds included, like the time frame queries of
+    the Neo4jController. Windows are cut out with a binary search on the event times."""
+
+    def __init__(self, links, length_days):
+        """
+        :param links:           pd.DataFrame with the columns source, target and event_time (ms since epoch)
+        :param length_days:     length of a window in days
+        """
+        links = links.sort_values(by="event_time", kind="mergesort")
+
+        self._times = links["event_time"].values.astype(np.int64)
+        self._sources = links["source"].values.astype(np.int64)
+        self._targets = links["target"].values.astype(np.int64)
+
+        self._length = length_days * _ms_per_day
+
+    def __len__(self):
+        return len(self._times)
+
+    def get_bounds(self, dt):
+        """
+        :param dt:      end date of the window
+        :return:        tuple of the first link in the window and the first link after it, as positions in the
+                        time-sorted links
+        """
+        end = self.to_ms(dt)
+        first = np.searchsorted(self._times, end - self._length, side="left")
+        stop = np.searchsorted(self._times, end, side="right")
+        return first, stop
+
+    def get_links(self, first, stop):
+        """
+        :param first:   position of the first link
+        :param stop:    position after the last link
+        :return:        tuple of lists with the sources and targets of the links
+        """
+        return self._sources[first:stop].tolist(), self._targets[first:stop].tolist()
+
+    def get_window(self, dt) -> pd.DataFrame:
+        """
+        :param dt:      end date of the window
+        :return:        pd.DataFrame with the distinct directed (source, target) pairs linked within the window
+        """
+        first, stop = self.get_bounds(dt)
+
+        pairs = np.unique(np.stack([self._sources[first:stop], self._targets[first:stop]], axis=1), axis=0)
+        return pd.DataFrame(pairs, columns=["source", "target"])
+
+    @staticmethod
+    def to_ms(dt):
+        """
+        :param dt:      date or datetime. Only the date is considered
+        :return:        ms since epoch of the date's midnight (UTC)
+        """
+        return int(datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class WindowGraph:
+    """communication graph of a window which slides forward over TemporalLinks.
+
+    The graph consists of the distinct directed (source, target) pairs linked within the window. As in the
+    nx.MultiGraph built from these pairs, a pair linked in both directions makes two parallel edges. When the window
+    moves, the links entering and leaving it are netted per pair, and only pairs which enter or leave the window
+    change the graph. The cost of a move therefore depends on the change between the windows.
+
+    Link counts per pair and node degrees are kept up to date on every move. Connected components are merged when an
+    edge joins them. When the last edge between two nodes of a component expires, the component is only marked.
+    Marked components are searched for splits once they are queried, at most once per move.
+
+    If with_graph is set, an nx.MultiGraph of the window is updated along with the counts."""
+
+    def __init__(self, temporal_links, with_graph=False):
+        """
+        :param temporal_links:      TemporalLinks the window slides over
+        :param with_graph:          if true, an nx.MultiGraph of the window is maintained
+        """
+        self._links = temporal_links
+        self._first = 0
+        self._stop = 0
+
+        # number of links per directed pair within the window
+        self._pair_counts = {}
+        # number of directed pairs per node and neighbor
+        self._adjacency = {}
+        self._degrees = {}
+
+        self._component_of = {}
+        self._members = {}
+        self._next_component = 0
+        # components which may have split since they were last searched
+        self._unsplit = set()
+
+        self._graph = nx.MultiGraph() if with_graph else None
+
+    def __len__(self):
+        return len(self._degrees)
+
+    def advance(self, dt):
+        """
+        moves the window to end at dt. Windows have to be passed in ascending order.
+
+        :param dt:      end date of the window
+        :return:        --
+        """
+        first, stop = self._links.get_bounds(dt)
+
+        changes = Counter(zip(*self._links.get_links(max(self._stop, first), stop)))
+        changes.subtract(Counter(zip(*self._links.get_links(self._first, min(first, self._stop)))))
+
+        # pairs entering the window come first, so nodes which keep some of their edges are not removed meanwhile
+        for pair, change in changes.items():
+            if change:
+                self._change_pair(pair, change)
+
+        self._first, self._stop = first, stop
+
+    def get_graph(self):
+        """
+        :return:        nx.MultiGraph of the window, with an edge per directed pair. It is changed in place when the
+                        window moves. The order of its nodes and edges follows the order in which they entered the
+                        window, so it is the same in every run. None, if the window graph was created without graph
+        """
+        return self._graph
+
+    def get_degrees(self):
+        """
+        :return:        dict with the degree of each node, parallel edges counted separately
+        """
+        return dict(self._degrees)
+
+    def degree_centrality(self):
+        """
+        :return:        dict with the degree centrality of each node as computed by nx.degree_centrality
+        """
+        if len(self._degrees) <= 1:
+            return {node: 1 for node in self._degrees}
+
+        scale = 1.0 / (len(self._degrees) - 1)
+        return {node: degree * scale for node, degree in self._degrees.items()}
+
+    def get_component(self, node):
+        """
+        :param node:    node id
+        :return:        id of the node's connected component. Ids stay the same while a component does not split
+        """
+        self._split_components()
+        return self._component_of[node]
+
+    def get_no_components(self):
+        self._split_components()
+        return len(self._members)
+
+    # -------- updates --------
+    def _change_pair(self, pair, change):
+        count = self._pair_counts.get(pair, 0)
+        if count + change == 0:
+            del self._pair_counts[pair]
+            self._remove_edge(*pair)
+        else:
+            self._pair_counts[pair] = count + change
+            if count == 0:
+                self._add_edge(*pair)
+
+    def _add_edge(self, u, v):
+        for node in (u, v):
+            if node not in self._degrees:
+                self._degrees[node] = 0
+                self._adjacency[node] = {}
+                self._component_of[node] = self._next_component
+                self._members[self._next_component] = {node}
+                self._next_component += 1
+
+        self._degrees[u] += 1
+        self._degrees[v] += 1
+
+        multiplicity = self._adjacency[u].get(v, 0)
+        self._adjacency[u][v] = multiplicity + 1
+        self._adjacency[v][u] = multiplicity + 1
+
+        if self._graph is not None:
+            self._graph.add_edge(u, v)
+
+        if multiplicity == 0:
+            self._merge_components(self._component_of[u], self._component_of[v])
+
+    def _remove_edge(self, u, v):
+        self._degrees[u] -= 1
+        self._degrees[v] -= 1
+
+        if self._graph is not None:
+            self._graph.remove_edge(u, v)
+
+        multiplicity = self._adjacency[u][v] - 1
+        if multiplicity > 0:
+            self._adjacency[u][v] = multiplicity
+            self._adjacency[v][u] = multiplicity
+            return
+
+        # a self loop has a single adjacency entry
+        del self._adjacency[u][v]
+        if u != v:
+            del self._adjacency[v][u]
+
+        for node in {u, v}:
+            if self._degrees[node] == 0:
+                self._remove_node(node)
+
+        if u in self._degrees and v in self._degrees and u != v:
+            self._unsplit.add(self._component_of[u])
+
+    def _remove_node(self, node):
+        component = self._component_of.pop(node)
+        members = self._members[component]
+        members.discard(node)
+        if not members:
+            del self._members[component]
+            self._unsplit.discard(component)
+
+        del self._degrees[node]
+        del self._adjacency[node]
+
+        if self._graph is not None:
+            self._graph.remove_node(node)
+
+    def _merge_components(self, a, b):
+        if a == b:
+            return
+
+        if len(self._members[a]) < len(self._members[b]):
+            a, b = b, a
+
+        for node in self._members[b]:
+            self._component_of[node] = a
+        self._members[a].update(self._members.pop(b))
+
+        if b in self._unsplit:
+            self._unsplit.discard(b)
+            self._unsplit.add(a)
+
+    def _split_components(self):
+        """searches the marked components and gives each part of a split component an id of its own"""
+        for component in sorted(self._unsplit):
+            unvisited = set(self._members[component])
+            first = True
+            while unvisited:
+                start = unvisited.pop()
+                reached = {start}
+                queue = deque([start])
+                while queue:
+                    for neighbor in self._adjacency[queue.popleft()]:
+                        if neighbor not in reached:
+                            reached.add(neighbor)
+                            queue.append(neighbor)
+                unvisited -= reached
+
+                # the first part keeps the component's id
+                if first:
+                    self._members[component] = reached
+                    first = False
+                    continue
+
+                new_component = self._next_component
+                self._next_component += 1
+                self._members[new_component] = reached
+                for node in reached:
+                    self._component_of[node] = new_component
+
+        self._unsplit.clear()
@@ -0,0 +1,78 @@
+"""
+MODULE: tokenizer
+
+Scans comment bodies for the markers the reference detectors work on: mentions, quote markers and line breaks.
+Each body is scanned once with a single compiled pattern.
+
+CLASSES:
+    CommentTokens
+
+FUNCTIONS:
+    tokenize
+"""
+import re
+from bisect import bisect_left
+
+_token_pattern = re.compile(r"(?P<mention>@)|(?P<line>\r\n)|(?P<quote>>+)")
+
+# a username ends with one of these characters or with the comment end
+_username_end_pattern = re.compile(r"[ '.@`,!?(){}\[\]/\\\"\n\t\r]")
+
+
+class CommentTokens:
+    """markers found in a comment body.
+
+    mentions:       list of (start, stop) tuples. body[start] is the @, body[start + 1:stop] the username
+    quotes:         positions of quote markers. A run of > defines a quote, if it begins the body or follows a
+                    line break. The position of the last > in the run is stored.
+    line_breaks:    positions of all \\r\\n in the body
+    """
+
+    __slots__ = ["body", "mentions", "quotes", "line_breaks"]
+
+    def __init__(self, body, mentions, quotes, line_breaks):
+        self.body = body
+        self.mentions = mentions
+        self.quotes = quotes
+        self.line_breaks = line_breaks
+
+    def line_end(self, position):
+        """
+        :param position:    position in the body
+        :return:            position of the first line break at or after position or the body length
+        """
+        i = bisect_left(self.line_breaks, position)
+        if i < len(self.line_breaks):
+            return self.line_breaks[i]
+        return len(self.body)
+
+
+def tokenize(body) -> CommentTokens:
+    """
+    :param body:    comment body
+    :return:        CommentTokens found in the body
+    """
+    if not isinstance(body, str):
+        body = str(body)
+
+    mentions = []
+    quotes = []
+    line_breaks = []
+
+    line_start = 0
+    for match in _token_pattern.finditer(body):
+        kind = match.lastgroup
+        start = match.start()
+
+        if kind == "mention":
+            end = _username_end_pattern.search(body, start + 2)
+            mentions.append((start, end.start() if end is not None else len(body)))
+
+        elif kind == "line":
+            line_breaks.append(start)
+            line_start = match.end()
+
+        elif start == line_start:
+            quotes.append(match.end() - 1)
+
+    return CommentTokens(body, mentions, quotes, line_breaks)
@@ -6,16 +6,73 @@ construct_network = True
 # data sources
 _import_data_folder = "Data/Import_Network"
 _prep_data_folder = "Data/Export_DataPrep"
-_relations_file = "Data/Relations/relations.csv"
+_relations_file = "Data/Relations/relations"
+_relations_shard_folder = "Data/Relations/shards"
+_ledger_file = "Data/Relations/progress_ledger.csv"
+_thread_cache_folder = "Data/Cache"
+_thread_state_folder = "Data/State"
+
+# parallel processing
+# owners are distributed to a pool of nc_workers processes. Each worker writes the relations of its owners to a
+# separate shard, shards are merged into the relations file in owner order after all owners are processed.
+nc_parallel = False
+nc_workers = 4
+
+# relations output
+# nc_relations_format is "csv" or "arrow". The arrow format is a sequence of zstd compressed Arrow IPC streams
+# (requires pyarrow). Relations are buffered and written in batches of at least nc_relations_batch rows.
+nc_relations_format = "csv"
+nc_relations_batch = 100000
+_relations_extensions = {"csv": "csv", "arrow": "arrows"}
+
+# streaming
+# if set, threads are dropped as soon as they have been run. Their references are validated and passed to the
+# relations writer whenever nc_stream_rows candidate references are buffered, instead of once per project.
+nc_streaming = False
+nc_stream_rows = 10000
 
 # export folders
 _viz_data_folder = "Data/Export_Network/viz_data"
 _plot_path = "Data/Export_Network/plots"
 _nx_measures_path = "Data/Export_Network/nx_measures"
 
+# thread cache
+# the candidate references of every thread are cached per owner. Threads whose comments did not change since the
+# last run are not processed again. Entries not used for nc_cache_max_age_days are evicted, as are the least
+# recently used entries exceeding nc_cache_max_mb.
+nc_thread_cache = False
+nc_cache_max_age_days = 180
+nc_cache_max_mb = 1024
+
+# incremental mode
+# the largest comment id processed and the contextual detector state of every thread are stored per owner. Runs in
+# incremental mode (main.py --incremental) only search comments after these high-water marks, so the relations file
+# only contains the relations of new comments. Mentions which were invalid, because the login was unknown or the
+# addressee didn't participate in the project yet, are validated again by every incremental run and written once they
+# became valid. A contextual reply which such a mention would have suppressed has already been written by an earlier
+# run. It is not taken back, but counted as superseded in the project stats. The thread cache is not used in
+# incremental mode.
+nc_incremental = False
+
+# rule sets
+# references are detected with each of the rule sets declared in classes/rules.py and tagged with the rule set's
+# name. Project stats refer to the first rule set.
+nc_rule_sets = ["relaxed"]
+
+# fuzzy quote attribution
+# quotes which can't be found literally in a previous comment are attributed to the first comment containing a line
+# with an estimated Jaccard similarity (character 3-grams) of at least nc_fuzzy_threshold
+nc_fuzzy_quotes = False
+nc_fuzzy_threshold = 0.6
+
 # collectors
+# invalid references are counted exactly, collect_sample_size of them are kept as a random sample. If collect_spill
+# is set, all invalid references are written to one file per owner in _collectors_folder.
 collect_invalid = False
 collect_position_nan = False
+collect_sample_size = 100
+collect_spill = False
+_collectors_folder = "Data/Collectors"
 
 # ---- neo4j parameters ----
 
@@ -37,6 +94,27 @@ a_degree_centrality = False or construct_network
 a_betweenness_centrality = True or construct_network
 a_eigenvector_centrality = True or construct_network
 
+# the measures of the weekly time frames are computed in a pool of a_workers processes, if a_parallel is set. Every
+# time frame gets its own seed derived from a_seed, so results don't depend on the number of processes. a_seed = None
+# makes results non-reproducible.
+a_parallel = False
+a_workers = 4
+a_seed = 0
+
+# if a_louvain_warm_start is set, the Louvain run of a time frame starts from the partition of the previous time
+# frame and community ids are kept stable between time frames. Time frames are processed serially then.
+a_louvain_warm_start = False
+
+# betweenness centrality
+# a_bc_mode is "exact", "approx" or "auto". The approximation samples a_bc_k pivot nodes. With probability
+# 1 - a_bc_delta, no estimate is off by more than sqrt(ln(2n / a_bc_delta) / (2 a_bc_k)). "auto" computes exact values
+# for time frames with at most a_bc_exact_max_nodes nodes and approximates larger ones. Mode, sample size and error
+# bound of every time frame are exported next to the betweenness centrality values.
+a_bc_mode = "auto"
+a_bc_exact_max_nodes = 2000
+a_bc_k = 500
+a_bc_delta = 0.1
+
 # ---- output parameters ----
 output_verbose = False
 
@@ -53,8 +131,42 @@ def get_pc_data_path(owner):
     return "{0}/PullRequestReviewCommentEvent/{1}".format(_prep_data_folder, owner)
 
 
+def get_ic_store_path(owner):
+    return "{0}/IssueCommentEvent/{1}.parquet".format(_prep_data_folder, owner)
+
+
+def get_cc_store_path(owner):
+    return "{0}/CommitCommentEvent/{1}.parquet".format(_prep_data_folder, owner)
+
+
+def get_pc_store_path(owner):
+    return "{0}/PullRequestReviewCommentEvent/{1}.parquet".format(_prep_data_folder, owner)
+
+
 def get_relations_file_path():
-    return _relations_file
+    return "{0}.{1}".format(_relations_file, _relations_extensions[nc_relations_format])
+
+
+def get_ledger_file_path():
+    return _ledger_file
+
+
+def get_relations_shard_path(owner):
+    return "{0}/{1}.{2}".format(_relations_shard_folder,
+                                owner.replace('/', '-'),
+                                _relations_extensions[nc_relations_format])
+
+
+def get_thread_cache_path(owner):
+    return "{0}/{1}.sqlite".format(_thread_cache_folder, owner.replace('/', '-'))
+
+
+def get_thread_state_path(owner):
+    return "{0}/{1}.sqlite".format(_thread_state_folder, owner.replace('/', '-'))
+
+
+def get_invalid_spill_path(owner):
+    return "{0}/invalid_{1}.csv".format(_collectors_folder, owner.replace('/', '-'))
 
 
 def get_nx_path(owner, i, repo=None):
@@ -5,24 +5,45 @@ core script to the network construction process. To start network construction,
 To configure the network construction process, set parameters in conf module
 """
 
+import argparse
 import time
 import pandas as pd
+import classes.collectors as collectors
 import conf as conf
+from classes.ledger import ProgressLedger
+from classes.participants import ActorRegistry
 from classes.project import Project
+from classes.relations import RelationsWriter, merge_relations
+from classes.rules import get_settings
+from classes.threadcache import ThreadCache
+from classes.threadstate import ThreadStateStore
 import cProfile
 import logging
+import multiprocessing
 import os
+import shutil
 
+# columns required from every comment data source
+_comment_columns = ["repo_id",
+                    "actor_id",
+                    "actor_login",
+                    "comment_body",
+                    "comment_id"]
 
-def main():
+
+def main(resume=False):
     """
     Calls the network construction process.
 
-    :return:    --
+    :param resume:  if true, continues an interrupted run based on the progress ledger
+    :return:        --
     """
     time_start = time.time()
 
-    _construct_network()
+    _construct_network(resume)
+
+    collectors.analyze_invalid_refs()
+    collectors.analyze_position_nan()
 
     print("------------------------------------------")
     print("Total process time elapsed:        {0:.2f}s".format(time.process_time()))
@@ -30,7 +51,7 @@ def main():
     print("------------------------------------------")
 
 
-def _construct_network():
+def _construct_network(resume=False):
     """
     Reads the owner/repository combinations from the file Import_Network/owners.csv. For each owner/repository
     which was filled in there, the network construction process is being started.
@@ -38,7 +59,14 @@ def _construct_network():
     file repos.csv provides owner-repository relations in a two-column format:
     header: owner_login, repo_id
 
-    :return:    --
+    If conf.nc_parallel is set, owners are processed in a pool of conf.nc_workers processes.
+
+    Every completed owner/repository is recorded in the progress ledger. When resuming, owner/repository
+    combinations found in the ledger are skipped and relations written after the last completed repository are
+    removed.
+
+    :param resume:  if true, continues an interrupted run based on the progress ledger
+    :return:        --
     """
 
     if not conf.construct_network:
@@ -47,87 +75,294 @@ def _construct_network():
     import_repos = pd.read_csv("Data/Import_Network/repos.csv", sep=',', header=0)
     owners = import_repos["owner_login"].unique()
 
+    ledger = ProgressLedger(conf.get_ledger_file_path())
+    # create the ledger before any worker records a repository
+    ledger.create()
+    completed = set()
+    if resume:
+        _check_resume_targets(ledger)
+        completed = ledger.get_completed()
+        logging.info("resuming: {0} repositories completed previously".format(len(completed)))
+        collectors.discard_spilled(completed)
+
+    if conf.nc_parallel:
+        _construct_network_parallel(import_repos, owners, completed)
+        return
+
+    relations_file = conf.get_relations_file_path()
+    ledger.truncate(relations_file)
+
     counter = 0
     num_owners = len(owners)
+    with _open_writer(relations_file, ledger) as writer:
+        for owner in owners:
+
+            repos = import_repos[import_repos["owner_login"] == owner]
+            repos = _filter_completed(owner, repos["repo_id"], completed)
+
+            if not repos.empty:
+                _split_projects(owner, repos, writer)
+
+            counter += 1
+            print("progress: {0}/{1}".format(counter, num_owners))
+            logging.info("processed: {0} ({1}/{2})".format(owner, counter, num_owners))
+
+
+def _construct_network_parallel(import_repos: pd.DataFrame, owners, completed: set):
+    """
+    Distributes owners to a process pool. Every worker writes the relations of an owner to a separate shard file.
+    After all owners have been processed, the shards are merged into the relations file in the order in which the
+    owners appear in repos.csv, so that the output does not depend on the order in which the workers finish.
+
+    :param import_repos:    owner-repository relations as read from repos.csv
+    :param owners:          owner names in the order of their first appearance in repos.csv
+    :param completed:       set of (owner, repo_id) tuples which have been processed in a previous run
+    :return:                --
+    """
+
+    os.makedirs(conf._relations_shard_folder, exist_ok=True)
+
+    jobs = []
     for owner in owners:
+        repos = import_repos[import_repos["owner_login"] == owner]["repo_id"]
+        repos = _filter_completed(owner, repos, completed)
+        if not repos.empty:
+            jobs.append((owner, repos.tolist()))
+
+    # schedule large owners first to keep all workers busy until the end of the run
+    jobs.sort(key=lambda job: _owner_data_size(job[0]), reverse=True)
+
+    counter = len(owners) - len(jobs)
+    num_owners = len(owners)
+    with multiprocessing.Pool(processes=conf.nc_workers, initializer=_init_worker) as pool:
+        for owner, collector_state in pool.imap_unordered(_process_owner, jobs):
+            collectors.merge_state(collector_state)
+            counter += 1
+            print("progress: {0}/{1}".format(counter, num_owners))
+            logging.info("processed: {0} ({1}/{2})".format(owner, counter, num_owners))
+
+    _merge_shards(owners)
+
+
+def _init_worker():
+    _configure_logging()
+
+
+def _process_owner(job):
+    """
+    Worker function. Processes all repositories of a single owner and writes the relations to the owner's shard.
 
-        repos = import_repos[import_repos["owner_login"] == owner]
-        repos = repos["repo_id"]
-        _split_projects(owner, repos)
+    :param job:     tuple of owner name and list of repository ids
+    :return:        tuple of owner name and the worker's collector state
+    """
+    owner, repos = job
+
+    shard_path = conf.get_relations_shard_path(owner)
+
+    ledger = ProgressLedger(conf.get_ledger_file_path())
+    ledger.truncate(shard_path)
+
+    with _open_writer(shard_path, ledger) as writer:
+        _split_projects(owner, pd.Series(repos), writer)
 
-        counter += 1
-        print("progress: {0}/{1}".format(counter, num_owners))
-        logging.info("processed: {0} ({1}/{2})".format(owner, counter, num_owners))
+    return owner, collectors.pop_state()
+
+
+def _open_writer(path: str, ledger: ProgressLedger) -> RelationsWriter:
+    """
+    :param path:        relations file or shard
+    :param ledger:      ProgressLedger completed repositories are recorded in
+    :return:            RelationsWriter configured as set in conf
+    """
+    return RelationsWriter(path, conf.nc_relations_format, conf.nc_relations_batch, ledger)
+
+
+def _filter_completed(owner: str, repos: pd.Series, completed: set) -> pd.Series:
+    """
+    :param owner:       owner name
+    :param repos:       pd.Series containing repository ids
+    :param completed:   set of (owner, repo_id) tuples which have been processed in a previous run
+    :return:            repositories which still have to be processed
+    """
+    if not completed:
+        return repos
 
-        with open("processed_owners.csv", 'w') as po:
-            po.write(owner)
+    return repos[[(owner, repo) not in completed for repo in repos]]
 
 
-def _split_projects(owner: str, repos: pd.Series):
+def _check_resume_targets(ledger: ProgressLedger):
+    """
+    Relations written in serial mode go to the relations file, relations written in parallel mode go to the owner
+    shards. A run can only be resumed in the mode it was started with.
+
+    :param ledger:  progress ledger of the interrupted run
+    :return:        --
+    """
+    relations_file = conf.get_relations_file_path()
+    for target in ledger.get_targets():
+        if (target == relations_file) == conf.nc_parallel:
+            raise ValueError("Cannot resume: the interrupted run was started with nc_parallel = {0}"
+                             .format(not conf.nc_parallel))
+
+
+def _owner_data_size(owner: str) -> int:
+    """
+    :param owner:   owner name
+    :return:        total size of the owner's comment data files in bytes
+    """
+    size = 0
+    for store_path, csv_path in [(conf.get_pc_store_path(owner), conf.get_pc_data_path(owner)),
+                                 (conf.get_ic_store_path(owner), conf.get_ic_data_path(owner)),
+                                 (conf.get_cc_store_path(owner), conf.get_cc_data_path(owner))]:
+        if os.path.isfile(store_path):
+            size += os.path.getsize(store_path)
+        elif os.path.isfile(csv_path):
+            size += os.path.getsize(csv_path)
+    return size
+
+
+def _merge_shards(owners):
+    """
+    Concatenates the owner shards in the given order into the relations file. The shards are kept until the run
+    has finished, so that the merge can be repeated when resuming a run that was interrupted during the merge.
+
+    :param owners:  owner names in output order
+    :return:        --
+    """
+    merge_relations([conf.get_relations_shard_path(owner) for owner in owners],
+                    conf.get_relations_file_path(),
+                    conf.nc_relations_format)
+
+    logging.info("merged {0} relation shards".format(len(owners)))
+
+
+def _split_projects(owner: str, repos: pd.Series, writer: RelationsWriter):
     """
     Creates a new Project-object for each owner/repo combination.
     Starts the analysis process on each Project
 
-    :param owner:       owner name
-    :param repos:       pd.Series containing repository names
-    :return:            --
+    :param owner:           owner name
+    :param repos:           pd.Series containing repository names
+    :param writer:          RelationsWriter the relations are passed to. Every repository is committed after its
+                            project has been run
+    :return:                --
     """
 
-    pullreq_data, issue_data, commit_data = _import_comment_data(owner)
+    pullreq_data, issue_data, commit_data, registry = _import_comment_data(owner)
 
-    for repo in repos:
-        proc_time_start = time.process_time()
+    pullreq_partitions = _partition_by_repo(pullreq_data)
+    issue_partitions = _partition_by_repo(issue_data)
+    commit_partitions = _partition_by_repo(commit_data)
 
-        if conf.output_verbose:
-            print(">>> analyzing {0}/{1}".format(owner, repo))
-        else:
-            print("analyzing {0}/{1}".format(owner, repo))
+    cache = None
+    if conf.nc_thread_cache and not conf.nc_incremental:
+        cache = ThreadCache(conf.get_thread_cache_path(owner), conf.nc_cache_max_age_days, conf.nc_cache_max_mb)
 
-        project_pullreq_data = pullreq_data[pullreq_data["repo_id"] == repo]
-        project_issue_data = issue_data[issue_data["repo_id"] == repo]
+    thread_states = None
+    if conf.nc_incremental:
+        thread_states = ThreadStateStore(conf.get_thread_state_path(owner), get_settings(conf.nc_rule_sets))
 
-        Project(project_pullreq_data, project_issue_data, commit_data, owner, repo).run()
+    try:
+        for repo in repos:
+            proc_time_start = time.process_time()
+
+            if conf.output_verbose:
+                print(">>> analyzing {0}/{1}".format(owner, repo))
+            else:
+                print("analyzing {0}/{1}".format(owner, repo))
+
+            project_pullreq_data = pullreq_partitions.get(repo, pullreq_data.iloc[0:0])
+            project_issue_data = issue_partitions.get(repo, issue_data.iloc[0:0])
+            project_commit_data = commit_partitions.get(repo, commit_data.iloc[0:0])
+
+            project = Project(project_pullreq_data, project_issue_data, project_commit_data, owner, repo, registry,
+                              writer, cache, thread_states)
+            project.run()
+
+            if cache is not None:
+                cache.commit()
+            writer.commit(owner, repo)
+
+            # thread states may only advance once the repository's relations are recorded in the ledger
+            if thread_states is not None:
+                writer.flush()
+                thread_states.commit()
+
+            if conf.output_verbose:
+                print("time required:                {0:.2f}s".format(time.process_time() - proc_time_start))
+                print()
+                print("---------------------------------")
+                print()
+            else:
+                print("{0:.2f}s".format(time.process_time() - proc_time_start))
+                print()
+    finally:
+        if cache is not None:
+            logging.info("thread cache {0}: {1} hits, {2} misses".format(owner, cache.no_hits, cache.no_misses))
+            cache.close()
+        if thread_states is not None:
+            thread_states.close()
+
+
+def _partition_by_repo(data: pd.DataFrame) -> dict:
+    """
+    splits the owner's comment data into one data frame per repository in a single pass over the data.
 
-        if conf.output_verbose:
-            print("time required:                {0:.2f}s".format(time.process_time() - proc_time_start))
-            print()
-            print("---------------------------------")
-            print()
-        else:
-            print("{0:.2f}s".format(time.process_time() - proc_time_start))
-            print()
+    :param data:    comment data of an owner
+    :return:        dictionary mapping repository ids to the repository's comment data
+    """
+    return {repo: repo_data for repo, repo_data in data.groupby("repo_id", sort=False)}
 
 
-def _import_comment_data(owner: str) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
+def _import_comment_data(owner: str) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, ActorRegistry):
     """
-    loads comment data from files.
+    loads comment data from files. Reads the typed store files written during data preparation and falls back to
+    the csv files for owners without store files.
+
+    Builds the owner's ActorRegistry and adds the actor keys to the comment data.
 
     :param owner:       owner name
-    :return:            tuple of pullrequest-, issue- and comment data
+    :return:            tuple of pullrequest-, issue- and comment data and the owner's actor registry
     """
-    try:
-        pc_data = pd.read_csv(conf.get_pc_data_path(owner))
-    except FileNotFoundError:
-        pc_data = None
-        print('file not found')
+    pc_data = _read_comment_data(conf.get_pc_store_path(owner),
+                                 conf.get_pc_data_path(owner),
+                                 _comment_columns + ["pull_request_id", "comment_position"])
 
-    try:
-        ic_data = pd.read_csv(conf.get_ic_data_path(owner))
-    except FileNotFoundError:
-        ic_data = None
-        print('file not found')
+    ic_data = _read_comment_data(conf.get_ic_store_path(owner),
+                                 conf.get_ic_data_path(owner),
+                                 _comment_columns + ["issue_id"])
 
-    try:
-        cc_data = pd.read_csv(conf.get_cc_data_path(owner))
-    except FileNotFoundError:
-        cc_data = None
-        print('file not found')
+    cc_data = _read_comment_data(conf.get_cc_store_path(owner),
+                                 conf.get_cc_data_path(owner),
+                                 _comment_columns + ["commit_id", "comment_position"])
 
     p_data, i_data, c_data = _clean_comment_data(pc_data, ic_data, cc_data)
 
+    registry = ActorRegistry([p_data, c_data, i_data])
+    p_data = registry.add_keys(p_data)
+    i_data = registry.add_keys(i_data)
+    c_data = registry.add_keys(c_data)
+
     print("Imported data for >>> " + owner)
 
-    return p_data, i_data, c_data
+    return p_data, i_data, c_data, registry
+
+
+def _read_comment_data(store_path: str, csv_path: str, columns: list):
+    """
+    :param store_path:  path to the owner's store file
+    :param csv_path:    path to the owner's csv file
+    :param columns:     columns to read from the store file
+    :return:            pd.DataFrame or None, if neither file exists
+    """
+    if os.path.isfile(store_path):
+        return pd.read_parquet(store_path, columns=columns)
+
+    try:
+        return pd.read_csv(csv_path)
+    except FileNotFoundError:
+        print('file not found')
+        return None
 
 
 def _clean_comment_data(pc, ic, cc):
@@ -152,15 +387,17 @@ def _clean_comment_data(pc, ic, cc):
     if pc is None:
         pc = dummy_df
     else:
-        pc = _position_na_filter(pc)
+        pc = _position_na_filter(_actor_na_filter(pc))
 
     if ic is None:
         ic = dummy_df
+    else:
+        ic = _actor_na_filter(ic)
 
     if cc is None:
         cc = dummy_df
     else:
-        cc = _position_na_filter(cc)
+        cc = _position_na_filter(_actor_na_filter(cc))
 
     pc = _rename_cols(pc)
     ic = _rename_cols(ic)
@@ -178,11 +415,32 @@ def _position_na_filter(data):
     :return:      data frame where na values have been replaced in the comment_position column
     """
 
+    collectors.add_position_nan(int(data["comment_position"].isna().sum()), len(data))
+
     data["comment_position"] = data["comment_position"].fillna(value=-1)
 
     return data
 
 
+def _actor_na_filter(data):
+    """
+    removes comments without actor. These comments can't be attributed to a user and would turn the actor_id
+    column into floats.
+
+    :param data:  data frame containing comment data
+    :return:      data frame with integer actor_id column
+    """
+
+    missing = data["actor_id"].isna()
+    if missing.any():
+        logging.info("removed {0} comments without actor_id".format(missing.sum()))
+        data = data[~missing]
+
+    data = data.astype({"actor_id": "int64"})
+
+    return data
+
+
 def _rename_cols(data):
     """
 
@@ -204,48 +462,79 @@ def _rename_cols(data):
 
 
 def clean_up():
-    # rename references file
+    # rename references file and progress ledger
     time_str = time.strftime("%y-%m-%d %H:%M:%S")
-    os.rename("Data/Relations/relations.csv",
-              "Data/Relations/" + time_str + "_relations.csv")
+    relations_file = conf.get_relations_file_path()
+    os.rename(relations_file,
+              "Data/Relations/" + time_str + "_" + os.path.basename(relations_file))
+
+    os.rename(conf.get_ledger_file_path(),
+              "Data/Relations/" + time_str + "_progress_ledger.csv")
 
-    os.rename("processed_owners.csv",
-              time_str + "_processed_owners.csv")
+    if os.path.isdir(conf._relations_shard_folder):
+        shutil.rmtree(conf._relations_shard_folder)
 
 
-def set_up():
-    relations_file = "Data/Relations/relations.csv"
+def set_up(resume=False):
+    if resume:
+        logging.info("resuming from {0}".format(conf.get_ledger_file_path()))
+        return
+
+    relations_file = conf.get_relations_file_path()
     file_exists = os.path.isfile(relations_file)
     if file_exists:
         os.remove(relations_file)
-        logging.info("removed relations.csv")
+        logging.info("removed {0}".format(os.path.basename(relations_file)))
 
-    processed_owners_file = "processed_owners.csv"
-    file_exists = os.path.isfile(processed_owners_file)
+    ledger_file = conf.get_ledger_file_path()
+    file_exists = os.path.isfile(ledger_file)
     if file_exists:
-        os.remove(processed_owners_file)
-        logging.info("removed processed_owners.csv")
+        os.remove(ledger_file)
+        logging.info("removed progress_ledger.csv")
 
+    if os.path.isdir(conf._relations_shard_folder):
+        shutil.rmtree(conf._relations_shard_folder)
+        logging.info("removed relation shards")
 
-if __name__ == '__main__':
+    if os.path.isdir(conf._collectors_folder):
+        shutil.rmtree(conf._collectors_folder)
+        logging.info("removed spilled invalid references")
 
+
+def _configure_logging():
     logging.basicConfig(filename='NC.log', level=logging.INFO, format='%(levelname)s: %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
 
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="network construction")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run, skipping repositories recorded in the progress ledger")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only search comments which arrived since the previous incremental run")
+    args = parser.parse_args()
+
+    if args.incremental:
+        conf.nc_incremental = True
+
+    _configure_logging()
+
     logging.info("Initialized")
     logging.warning("starting process now")
 
-    set_up()
+    set_up(args.resume)
 
     logging.info("Started reference detection")
 
     try:
         # cProfile.run("main()", sort="cumtime")
-        main()
+        main(args.resume)
     except Exception as e:
         logging.exception(str(e))
+        logging.warning("Reference detection aborted. Restart with --resume to continue")
+    else:
+        logging.info("Finished reference detection")
 
-    logging.info("Finished reference detection")
-
-    clean_up()
+        clean_up()
 
-    logging.info("Completed")
+        logging.info("Completed")
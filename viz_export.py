@@ -1,3 +1,7 @@
+from collections import Counter
+import math
+import multiprocessing
+import pickle
 import time
 import conf
 
@@ -9,6 +13,7 @@ from dateutil import rrule
 import json
 
 from classes.neocontroller import Neo4jController
+from classes.timewindows import TemporalLinks, WindowGraph
 
 
 def analyze_repos(owners):
@@ -31,8 +36,12 @@ class Analyzer:
 
         self._startdt, self._enddt = self._controller.get_comment_timeframe(self._owner)
 
+        # all links of the owner are fetched once, time frames are cut out in memory
+        self._links = TemporalLinks(self._controller.get_communication_links(self._owner), conf.a_length_timeframe)
+
         self._degree_centrality = None
         self._betweenness_centrality = None
+        self._betweenness_info = None
         self._eigenvector_centrality = None
         self._partition = None
         self._modularity = None
@@ -60,15 +69,16 @@ class Analyzer:
         print("Running NX Louvain algorithm for {0} and timeframe length {1}".format(self._owner,
                                                                                      conf.a_length_timeframe))
         res = {}
+        window_graph = WindowGraph(self._links, with_graph=True)
         for dt in rrule.rrule(rrule.WEEKLY, dtstart=self._startdt, until=self._enddt):
             time_start = time.time()
 
-            links = self._controller.get_communication_subgraph(self._owner, dt)
+            window_graph.advance(dt)
 
-            if not links.empty:
-                nxgraph = nx.from_pandas_dataframe(links, source="source", target="target", create_using=nx.MultiGraph())
+            if len(window_graph):
+                nxgraph = window_graph.get_graph()
 
-                partition = nxlouvain.best_partition(nxgraph)
+                partition = nxlouvain.best_partition(nxgraph, random_state=get_window_seed(dt))
 
                 # partition = self.convert_keys_to_string(partition)
 
@@ -79,55 +89,40 @@ class Analyzer:
         return res
 
     def _individual_measures(self):
+        """
+        Computes the measures of every weekly time frame. Degree centrality is taken from the window graph, the
+        other measures are computed per time frame by _window_measures on the window graph's nx.MultiGraph. If
+        conf.a_parallel is set, time frames are distributed to a pool of conf.a_workers processes, which receive a
+        pickled copy of the graph. Results are collected in date order and, since every time frame gets its own seed
+        derived from conf.a_seed and the copies keep the order of nodes and edges, match the results of a serial run.
+
+        If conf.a_louvain_warm_start is set, each time frame's Louvain run starts from the partition of the previous
+        time frame, so time frames are processed serially.
+
+        :return:    --
+        """
 
         print("Running NX analysis for {0} and timeframe length {1}".format(self._owner,
                                                                             conf.a_length_timeframe))
         res_louvain = {}
         res_degree_centrality = {}
         res_betweenness_centrality = {}
+        res_betweenness_info = {}
         res_eigenvector_centrality = {}
         res_modularity = {}
 
         time_start = time.time()
-        for dt in rrule.rrule(rrule.WEEKLY, dtstart=self._startdt, until=self._enddt):
-            lap_time = time.time()
-
-            links = self._controller.get_communication_subgraph(self._owner, dt)
-
-            if not links.empty:
-                multi_graph = nx.from_pandas_dataframe(links,
-                                                       source="source",
-                                                       target="target",
-                                                       create_using=nx.MultiGraph())
-
-                if conf.a_louvain:
-                    partition = nxlouvain.best_partition(multi_graph)
-                    res_louvain[dt.strftime("%Y-%m-%d")] = partition
-
-                if conf.a_betweenness_centrality:
-                    bc = nx.betweenness_centrality(multi_graph, normalized=True)
-                    res_betweenness_centrality[dt.strftime("%Y-%m-%d")] = bc
-
-                if conf.a_degree_centrality:
-                    dc = nx.degree_centrality(multi_graph)
-                    res_degree_centrality[dt.strftime("%Y-%m-%d")] = dc
 
-                if conf.a_modularity:
-                    mod = nxlouvain.modularity(partition, multi_graph)
-                    res_modularity[dt.strftime("%Y-%m-%d")] = mod
-
-                if conf.a_eigenvector_centrality:
-                    pass
-                    # simple_graph = self.convert_to_simple(multi_graph)
-
-                    # TODO: eigenvector centrality calculation fails occasionally
-                    # reason may be that nx.eigenvector_centrality() can't handle star graphs
-                    # https://stackoverflow.com/questions/43208737/using-networkx-to-calculate-eigenvector-centrality
-                    # ec = nx.eigenvector_centrality(simple_graph)
-                    # res_eigenvector_centrality[dt.strftime("%Y-%m-%d")] = ec
-
-            if conf.output_verbose:
-                print("current: {0} - time: {0:.2f}s".format(dt.date(), time.time() - lap_time))
+        if conf.a_parallel and not conf.a_louvain_warm_start:
+            with multiprocessing.Pool(processes=conf.a_workers) as pool:
+                results = pool.imap(_window_measures, self._window_jobs(res_degree_centrality, copy=True))
+                self._collect_measures(results, res_louvain, res_betweenness_centrality, res_betweenness_info,
+                                       res_modularity)
+        else:
+            louvain = WarmStartLouvain() if conf.a_louvain_warm_start else None
+            results = (_window_measures(job, louvain) for job in self._window_jobs(res_degree_centrality))
+            self._collect_measures(results, res_louvain, res_betweenness_centrality, res_betweenness_info,
+                                   res_modularity)
 
         print("{0:.2f}s".format(time.time()-time_start))
         print()
@@ -135,14 +130,64 @@ class Analyzer:
         self._modularity = res_modularity
         self._degree_centrality = res_degree_centrality
         self._betweenness_centrality = res_betweenness_centrality
+        self._betweenness_info = res_betweenness_info
         self._degree_centrality = res_degree_centrality
         self._eigenvector_centrality = res_eigenvector_centrality
         self._partition = res_louvain
 
+    def _window_jobs(self, res_degree_centrality, copy=False):
+        """
+        Slides the window graph over the time frames and yields a job per non-empty time frame. Degree centrality
+        is computed on the way.
+
+        :param res_degree_centrality:   dict the degree centrality per time frame is added to
+        :param copy:                    if true, jobs hold a pickled copy of the window's graph. Otherwise, they hold
+                                        the graph itself, which changes once the next job is requested
+        :return:                        generator of (date, graph, seed) tuples, see _window_measures
+        """
+        with_graph = conf.a_louvain or conf.a_betweenness_centrality or conf.a_modularity
+
+        window_graph = WindowGraph(self._links, with_graph=with_graph)
+        for dt in rrule.rrule(rrule.WEEKLY, dtstart=self._startdt, until=self._enddt):
+            window_graph.advance(dt)
+
+            if len(window_graph):
+                if conf.a_degree_centrality:
+                    res_degree_centrality[dt.strftime("%Y-%m-%d")] = window_graph.degree_centrality()
+
+                if with_graph:
+                    graph = window_graph.get_graph()
+                    if copy:
+                        graph = pickle.dumps(graph, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield dt.strftime("%Y-%m-%d"), graph, get_window_seed(dt)
+
+    @staticmethod
+    def _collect_measures(results, res_louvain, res_betweenness_centrality, res_betweenness_info, res_modularity):
+        """
+        :param results:     iterable of the results of _window_measures in date order
+        :return:            --
+        """
+        for date, measures, duration in results:
+            if "louvain" in measures:
+                res_louvain[date] = measures["louvain"]
+
+            if "bc" in measures:
+                res_betweenness_centrality[date] = measures["bc"]
+                res_betweenness_info[date] = measures["bc_info"]
+
+            if "mod" in measures:
+                res_modularity[date] = measures["mod"]
+
+            if conf.output_verbose:
+                print("current: {0} - time: {1:.2f}s".format(date, duration))
+
     def _export_measures(self):
         if conf.a_betweenness_centrality:
             pd.DataFrame.from_dict(self._betweenness_centrality)\
                 .to_csv(conf.get_nx_path(self._owner, "bc",  self._repo))
+            pd.DataFrame.from_dict(self._betweenness_info, orient="index")\
+                .reindex(columns=["mode", "nodes", "k", "error"])\
+                .to_csv(conf.get_nx_path(self._owner, "bc_info", self._repo))
 
         if conf.a_degree_centrality:
             pd.DataFrame.from_dict(self._degree_centrality)\
@@ -245,6 +290,157 @@ class Analyzer:
             json.dump(data, fp, indent="\t")
 
 
+def get_window_seed(dt):
+    """
+    :param dt:      end date of a time frame
+    :return:        seed of the time frame's random computations, derived from conf.a_seed. None, if conf.a_seed is
+                    None
+    """
+    if conf.a_seed is None:
+        return None
+    return (conf.a_seed * 1000003 + dt.toordinal()) % 2 ** 32
+
+
+def betweenness_centrality(multi_graph, seed=None):
+    """
+    Computes betweenness centrality exactly or approximately from a_bc_k sampled pivots, as configured by
+    conf.a_bc_mode. Parallel edges don't change shortest path counts, so values are computed on the simple graph.
+
+    :param multi_graph:     nx.MultiGraph of a time frame
+    :param seed:            seed of the pivot sampling
+    :return:                tuple of a dict with the normalized betweenness centrality of each node and a dict with the
+                            mode, the number of nodes, the number of pivots k and the error bound
+    """
+    if conf.a_bc_mode not in ("exact", "approx", "auto"):
+        raise ValueError("unknown betweenness centrality mode '{0}'".format(conf.a_bc_mode))
+
+    simple_graph = Analyzer.convert_to_simple(multi_graph)
+    no_nodes = simple_graph.number_of_nodes()
+
+    approx = conf.a_bc_mode == "approx" or (conf.a_bc_mode == "auto" and no_nodes > conf.a_bc_exact_max_nodes)
+    if not approx or conf.a_bc_k >= no_nodes:
+        bc = nx.betweenness_centrality(simple_graph, normalized=True)
+        return bc, {"mode": "exact", "nodes": no_nodes, "k": no_nodes, "error": 0.0}
+
+    bc = nx.betweenness_centrality(simple_graph, k=conf.a_bc_k, normalized=True, seed=seed)
+    error = math.sqrt(math.log(2 * no_nodes / conf.a_bc_delta) / (2 * conf.a_bc_k))
+    return bc, {"mode": "approx", "nodes": no_nodes, "k": conf.a_bc_k, "error": error}
+
+
+class WarmStartLouvain:
+    """Louvain community detection over consecutive time frames.
+
+    Each run starts from the partition of the previous time frame instead of singletons. Nodes that are still present
+    keep their previous community. Previous communities are split into their connected parts in the current graph,
+    and new nodes start as singletons. Afterwards, communities are relabeled with the previous community they overlap
+    most with, so ids stay the same between adjacent time frames. Communities without a match get ids that have not
+    been used before."""
+
+    def __init__(self):
+        self._previous = None
+        self._next_label = 0
+
+    def best_partition(self, graph, seed=None):
+        """
+        :param graph:       nx.MultiGraph of the time frame. Time frames have to be passed in date order
+        :param seed:        random state of the Louvain run
+        :return:            dict with the community of each node
+        """
+        if self._previous is None:
+            partition = nxlouvain.best_partition(graph, random_state=seed)
+        else:
+            partition = nxlouvain.best_partition(graph, partition=self._seed_partition(graph), random_state=seed)
+
+        partition = self._relabel(partition)
+        self._previous = partition
+        return partition
+
+    def _seed_partition(self, graph):
+        members = {}
+        for node in graph:
+            if node in self._previous:
+                members.setdefault(self._previous[node], []).append(node)
+
+        seed_partition = {}
+        label = 0
+        for community in sorted(members):
+            for component in nx.connected_components(graph.subgraph(members[community])):
+                for node in component:
+                    seed_partition[node] = label
+                label += 1
+
+        for node in graph:
+            if node not in seed_partition:
+                seed_partition[node] = label
+                label += 1
+
+        return seed_partition
+
+    def _relabel(self, partition):
+        overlaps = Counter()
+        if self._previous is not None:
+            overlaps.update((community, self._previous[node]) for node, community in partition.items()
+                            if node in self._previous)
+
+        labels = {}
+        used = set()
+        for (community, previous), count in sorted(overlaps.items(), key=lambda item: (-item[1], item[0])):
+            if community not in labels and previous not in used:
+                labels[community] = previous
+                used.add(previous)
+
+        for community in sorted(set(partition.values())):
+            if community not in labels:
+                labels[community] = self._next_label
+                self._next_label += 1
+
+        self._next_label = max(self._next_label, max(labels.values(), default=-1) + 1)
+
+        return {node: labels[community] for node, community in partition.items()}
+
+
+def _window_measures(job, louvain=None):
+    """
+    Computes the measures of a single time frame. Runs in pool workers, if the analysis is run in parallel.
+
+    :param job:     tuple of the time frame's date string, its nx.MultiGraph or a pickled copy of it and its seed
+    :param louvain: WarmStartLouvain carrying the partition of the previous time frame or None
+    :return:        tuple of the date string, a dict with the measures "louvain", "bc", "bc_info" and "mod" as
+                    configured, and the computation time in seconds
+    """
+    date, multi_graph, seed = job
+    time_start = time.time()
+
+    if isinstance(multi_graph, bytes):
+        multi_graph = pickle.loads(multi_graph)
+    measures = {}
+
+    if conf.a_louvain:
+        if louvain is not None:
+            partition = louvain.best_partition(multi_graph, seed)
+        else:
+            partition = nxlouvain.best_partition(multi_graph, random_state=seed)
+        measures["louvain"] = partition
+
+    if conf.a_betweenness_centrality:
+        measures["bc"], measures["bc_info"] = betweenness_centrality(multi_graph, seed)
+
+    if conf.a_modularity:
+        measures["mod"] = nxlouvain.modularity(partition, multi_graph)
+
+    if conf.a_eigenvector_centrality:
+        pass
+        # simple_graph = Analyzer.convert_to_simple(multi_graph)
+
+        # TODO: eigenvector centrality calculation fails occasionally
+        # reason may be that nx.eigenvector_centrality() can't handle star graphs
+        # https://stackoverflow.com/questions/43208737/using-networkx-to-calculate-eigenvector-centrality
+        # ec = nx.eigenvector_centrality(simple_graph)
+        # res_eigenvector_centrality[dt.strftime("%Y-%m-%d")] = ec
+
+    return date, measures, time.time() - time_start
+
+
 if __name__ == '__main__':
     owners = [
         'OneDrive',